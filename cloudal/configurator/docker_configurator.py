@@ -19,11 +19,12 @@ class docker_configurator(object):
         """
         logger.info('Starting installing Docker on %s hosts' % len(self.hosts))
         configurator = packages_configurator()
-        configurator.install_packages(['wget'], self.hosts)
+        configurator.install_packages(['wget'], self.hosts, is_desired_state=True)
+        # the hosts which already have Docker are skipped
         logger.info('Downloading the official get_docker script')
-        cmd = 'wget https://get.docker.com -O get-docker.sh'
+        cmd = 'command -v docker > /dev/null || wget https://get.docker.com -O get-docker.sh'
         self.error_hosts = execute_cmd(cmd, self.hosts)
         logger.info('Installing Docker by using get_docker script')
-        cmd = 'sh get-docker.sh'
+        cmd = 'command -v docker > /dev/null || sh get-docker.sh'
         self.error_hosts = execute_cmd(cmd, self.hosts)
         logger.info('Finish installing Docker on %s hosts' % len(self.hosts))
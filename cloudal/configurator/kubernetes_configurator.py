@@ -30,7 +30,7 @@ class kubernetes_configurator(object):
 
         logger.debug('Installing kubeadm kubelet kubectl')
         configurator = packages_configurator()
-        configurator.install_packages(['apt-transport-https', 'curl'], self.hosts)
+        configurator.install_packages(['apt-transport-https', 'curl'], self.hosts, is_desired_state=True)
 
         cmd = 'curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | sudo apt-key add -'
         execute_cmd(cmd, self.hosts)
@@ -39,7 +39,7 @@ class kubernetes_configurator(object):
                 deb https://apt.kubernetes.io/ kubernetes-xenial main'''
         execute_cmd(cmd, self.hosts)
 
-        configurator.install_packages(['kubelet', 'kubeadm', 'kubectl'], self.hosts)
+        configurator.install_packages(['kubelet', 'kubeadm', 'kubectl'], self.hosts, is_desired_state=True)
 
     def deploy_kubernetes_cluster(self):
         configurator = docker_configurator(self.hosts)
@@ -1,6 +1,6 @@
 from time import sleep
 
-from cloudal.utils import get_logger, execute_cmd
+from cloudal.utils import get_logger, execute_cmd, processes_by_host, host_facts_cache
 
 logger = get_logger()
 
@@ -37,10 +37,50 @@ OS_NAMES = {
 
 MAX_RETRIES = 10
 
+# the port of the apt-cacher-ng caching proxy
+APT_CACHE_PORT = 3142
+# the package index is updated again if the last update is older than this number of minutes
+APT_INDEX_MAX_AGE = 60
+APT_UPDATE_STAMP = '/var/lib/apt/cloudal-update-stamp'
+
 
 class packages_configurator(object):
 
-    def install_packages_with_apt(self, packages, hosts):
+    def setup_apt_cache(self, proxy_host, hosts, port=APT_CACHE_PORT, proxy_url=None):
+        '''Use a caching proxy for the apt packages of the given hosts
+
+        apt-cacher-ng is installed on proxy_host and all hosts are configured to download
+        their packages through it, so that each package is downloaded from upstream only once.
+        HTTPS repositories are still accessed directly.
+
+        Parameters
+        ----------
+        proxy_host: str
+            the hostname of the node to run the caching proxy on
+
+        hosts: list of string
+            the list of hostnames that use the caching proxy
+
+        port: int
+            the port of the caching proxy
+
+        proxy_url: str
+            the url of an existing proxy (e.g. a local stand-in repository) to use
+            instead of installing apt-cacher-ng on proxy_host
+
+        '''
+        if proxy_url is None:
+            logger.info('Setting up an apt caching proxy on %s' % proxy_host)
+            self.install_packages_with_apt(['apt-cacher-ng'], [proxy_host])
+            cmd = ("sed -i 's/^#* *Port:.*/Port: %s/' /etc/apt-cacher-ng/acng.conf && "
+                   "systemctl restart apt-cacher-ng") % port
+            execute_cmd(cmd, proxy_host)
+            proxy_url = 'http://%s:%s' % (proxy_host, port)
+        logger.info('Configuring %s hosts to use the apt caching proxy %s' % (len(hosts), proxy_url))
+        cmd = "echo 'Acquire::http::Proxy \"%s\";' > /etc/apt/apt.conf.d/01cloudal-proxy" % proxy_url
+        execute_cmd(cmd, hosts)
+
+    def install_packages_with_apt(self, packages, hosts, index_max_age=APT_INDEX_MAX_AGE):
         '''Install a list of given packages
 
         Parameters
@@ -51,11 +91,18 @@ class packages_configurator(object):
         hosts: list of string
             the list of hostnames
 
+        index_max_age: int
+            skip apt-get update if the package index was updated less than index_max_age minutes ago
+            and the apt sources have not changed since, set to 0 to always update
+
         '''
         logger.debug("Installing packages: %s on %s hosts" % (', '.join(packages), len(hosts)))
+        update_cmd = ('if [ -z "$(find {stamp} -mmin -{age} 2>/dev/null)" ] || '
+                      '[ -n "$(find /etc/apt -newer {stamp} 2>/dev/null)" ]; '
+                      'then apt-get update && touch {stamp}; fi').format(stamp=APT_UPDATE_STAMP, age=index_max_age)
         cmd = ("export DEBIAN_FRONTEND=noninteractive && "
-               "apt-get update && "
-               "apt-get install -q -y --allow-change-held-packages %s") % ' '.join(packages)
+               "%s && "
+               "apt-get install -q -y --allow-change-held-packages %s") % (update_cmd, ' '.join(packages))
         try:
             execute_cmd(cmd, hosts)
         except Exception as e:
@@ -101,6 +148,59 @@ class packages_configurator(object):
         except Exception as e:
             logger.error("---> Bug [%s] with command: %s" % (e, cmd), exc_info=True)
 
+    def _parse_os_name(self, os_info):
+        for os_name, os_full_name in OS_NAMES.items():
+            if os_name in os_info:
+                return os_name, os_full_name
+        return None, None
+
+    def _get_os_names(self, hosts):
+        '''Get the OS names of a list of hosts
+
+        All the hosts are probed at once and the result is cached per host,
+        until the host is redeployed (see cloudal.utils.clear_host_facts)
+
+        Parameters
+        ----------
+        hosts: list of str
+            the list of hostnames
+
+        Returns
+        -------
+        dict
+            key: str, the host name
+            value: tuple (os_name, os_full_name), (None, None) if no OS name is found
+        '''
+        os_names = dict()
+        pending_hosts = list()
+        for host in hosts:
+            if 'os_name' in host_facts_cache.get(host, dict()):
+                os_names[host] = host_facts_cache[host]['os_name']
+            else:
+                pending_hosts.append(host)
+
+        cmd = 'hostnamectl | grep "Operating System"'
+        for attempt in range(MAX_RETRIES):
+            if not pending_hosts:
+                break
+            if attempt > 0:
+                logger.info('---> Retrying: "%s" on %s hosts' % (cmd, len(pending_hosts)))
+                sleep(10)
+            _, r = execute_cmd(cmd, pending_hosts)
+            processes = processes_by_host(r) if r else dict()
+            for host in list(pending_hosts):
+                if host not in processes:
+                    continue
+                os_info = processes[host].stdout.strip().lower()
+                if os_info:
+                    os_names[host] = self._parse_os_name(os_info)
+                    host_facts_cache.setdefault(host, dict())['os_name'] = os_names[host]
+                    logger.debug('OS of %s: %s' % (host, os_names[host][1]))
+                    pending_hosts.remove(host)
+        for host in pending_hosts:
+            os_names[host] = (None, None)
+        return os_names
+
     def _get_os_name(self, host):
         '''Get the OS name of a host
 
@@ -117,22 +217,54 @@ class packages_configurator(object):
             full name of an OS
 
         '''
-        os_name = None
-        for attempt in range(MAX_RETRIES):
-            cmd = 'hostnamectl | grep "Operating System"'
-            _, r = execute_cmd(cmd, host)
-            os_info = r.processes[0].stdout.strip().lower()
-            if os_info:
-                for os_name, os_full_name in OS_NAMES.items():
-                    if os_name in os_info:
-                        logger.debug('OS of %s: %s' % (host, os_full_name))
-                        return os_name, os_full_name
-                return None, None
-            logger.info('---> Retrying: "%s" on host %s ' % (cmd, host))
-            sleep(10)
-        return None, None
+        return self._get_os_names([host])[host]
+
+    def _get_missing_packages(self, packages, hosts, os_name):
+        '''Get the packages that are not installed yet (or not in the required version) on each host
+
+        The installed packages of all hosts are queried in one round trip.
+
+        Parameters
+        ----------
+        packages: list of string
+            the list of package names, a version can be given with name=version
+
+        hosts: list of string
+            the list of hostnames
+
+        os_name: str
+            code name of the OS of the hosts
+
+        Returns
+        -------
+        dict
+            key: str, the host name
+            value: list of string, the packages to install on that host
+        '''
+        package_names = [package.split('=')[0] for package in packages]
+        if os_name in ['debian', 'ubuntu']:
+            cmd = "dpkg-query -W -f='${Package} ${Version} ${db:Status-Status}\\n' %s 2>/dev/null; true"
+        else:
+            cmd = "rpm -q --qf '%%{NAME} %%{VERSION}-%%{RELEASE} installed\\n' %s 2>/dev/null; true"
+        _, r = execute_cmd(cmd % ' '.join(package_names), hosts)
+        processes = processes_by_host(r) if r else dict()
 
-    def install_packages(self, packages, hosts):
+        missing_packages = dict()
+        for host in hosts:
+            installed_versions = dict()
+            if host in processes:
+                for line in processes[host].stdout.strip().splitlines():
+                    fields = line.split()
+                    if len(fields) == 3 and fields[2] == 'installed':
+                        installed_versions[fields[0]] = fields[1]
+            missing_packages[host] = list()
+            for package in packages:
+                name, _, version = package.partition('=')
+                if name not in installed_versions or (version and installed_versions[name] != version):
+                    missing_packages[host].append(package)
+        return missing_packages
+
+    def install_packages(self, packages, hosts, is_desired_state=False):
         '''Install a list of given packages
 
         Parameters
@@ -143,23 +275,40 @@ class packages_configurator(object):
         hosts: list of string
             the list of hostnames
 
+        is_desired_state: bool
+            only install the packages which are missing on each host,
+            the hosts which already have all the packages are not touched
+
         '''
         list_os_hosts = dict()
         logger.info("Installing packages: %s" % ', '.join(packages))
 
-        for host in hosts:
-            os_name, os_full_name = self._get_os_name(host)
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        for host, (os_name, os_full_name) in self._get_os_names(hosts).items():
             if os_name:
                 list_os_hosts[os_name] = list_os_hosts.get(os_name, list()) + [host]
             else:
                 logger.error('Cannot install %s on %s due to no OS name found' % (packages, host))
 
         for os_name, list_hosts in list_os_hosts.items():
-            if os_name in ['debian', 'ubuntu']:
-                self.install_packages_with_apt(packages, list_hosts)
-            elif os_name in ['centos']:
-                self.install_packages_with_yum(packages, list_hosts)
-            elif os_name in ['fedora']:
-                self.install_packages_with_dnf(packages, list_hosts)
-            else:
-                logger.info('Not support to install packages on OS %s yet' % os_name)
+            # group the hosts which need the same packages
+            list_packages_hosts = {tuple(packages): list_hosts}
+            if is_desired_state and os_name in ['debian', 'ubuntu', 'centos', 'fedora']:
+                list_packages_hosts = dict()
+                for host, missing_packages in self._get_missing_packages(packages, list_hosts, os_name).items():
+                    key = tuple(missing_packages)
+                    list_packages_hosts[key] = list_packages_hosts.get(key, list()) + [host]
+                if () in list_packages_hosts:
+                    logger.info('All packages are already installed on %s hosts' % len(list_packages_hosts.pop(())))
+
+            for packages_to_install, packages_hosts in list_packages_hosts.items():
+                packages_to_install = list(packages_to_install)
+                if os_name in ['debian', 'ubuntu']:
+                    self.install_packages_with_apt(packages_to_install, packages_hosts)
+                elif os_name in ['centos']:
+                    self.install_packages_with_yum(packages_to_install, packages_hosts)
+                elif os_name in ['fedora']:
+                    self.install_packages_with_dnf(packages_to_install, packages_hosts)
+                else:
+                    logger.info('Not support to install packages on OS %s yet' % os_name)
@@ -5,4 +5,7 @@ from .exp_g5k_utils import (
     create_combs_queue,
     is_job_alive,
     get_cores_hosts,
+    get_hosts_attributes,
+    get_cluster_hardware,
+    get_site_network,
     get_results)
@@ -2,16 +2,87 @@ from time import sleep
 import os
 import re
 
-from cloudal.utils import get_logger, getput_file
+from cloudal.utils import get_logger, get_compressed_files, sync_files, read_cache_file, write_cache_file
 
 from execo_engine import utils, sweep, ParamSweeper
-from execo_g5k import get_host_attributes, get_oar_job_info
+from execo_g5k import get_oar_job_info
+from execo_g5k.api_utils import get_resource_attributes, get_host_cluster, get_host_site, get_host_shortname
 
 
 logger = get_logger()
 
+# the time to live (in seconds) of the cached Grid5000 reference API data
+G5K_API_CACHE_TTL = 24 * 3600
+
+
+def get_g5k_api_resource(path, ttl=G5K_API_CACHE_TTL):
+    """Get a resource of the Grid5000 reference API, cached on the local disk
+
+    Parameters
+    ----------
+    path: str
+        the path of the resource in the API (e.g. sites/nancy/clusters/grisou)
+
+    ttl: int
+        the time to live of the cached resource in seconds
+
+    Returns
+    -------
+    dict
+        the attributes of the resource
+    """
+    cache_name = os.path.join('g5k_api', '%s.json' % path.strip('/').replace('/', '_'))
+    attributes = read_cache_file(cache_name, ttl)
+    if attributes is None:
+        logger.debug('Fetching %s from the Grid5000 API' % path)
+        attributes = get_resource_attributes(path)
+        write_cache_file(cache_name, attributes)
+    return attributes
+
+
+def get_cluster_hardware(site, cluster, ttl=G5K_API_CACHE_TTL):
+    """Get the attributes of a Grid5000 cluster (e.g. model, queues, created_at)"""
+    return get_g5k_api_resource('sites/%s/clusters/%s' % (site, cluster), ttl)
+
+
+def get_site_network(site, ttl=G5K_API_CACHE_TTL):
+    """Get the list of network equipments of a Grid5000 site"""
+    return get_g5k_api_resource('sites/%s/network_equipments' % site, ttl)['items']
+
+
+def get_hosts_attributes(hosts, ttl=G5K_API_CACHE_TTL):
+    """Get the attributes of a list of Grid5000 hosts with one request per cluster
+
+    Parameters
+    ----------
+    hosts: list
+        a list of hosts (e.g. econome-8.nantes.grid5000.fr)
+
+    ttl: int
+        the time to live of the cached attributes in seconds
+
+    Returns
+    -------
+    dict
+        key: str, name of host
+        value: dict, the attributes of the host
+    """
+    hosts_by_cluster = dict()
+    for host in hosts:
+        # host address has the form of <node>.<site>.grid5000.fr
+        site = host.split('.')[1] if host.count('.') >= 2 else get_host_site(host)
+        hosts_by_cluster.setdefault((site, get_host_cluster(host)), list()).append(host)
+
+    hosts_attributes = dict()
+    for (site, cluster), cluster_hosts in hosts_by_cluster.items():
+        nodes = get_g5k_api_resource('sites/%s/clusters/%s/nodes' % (site, cluster), ttl)['items']
+        nodes = {node['uid']: node for node in nodes}
+        for host in cluster_hosts:
+            if get_host_shortname(host) in nodes:
+                hosts_attributes[host] = nodes[get_host_shortname(host)]
+    return hosts_attributes
+
 
-# TODO: retry
 def get_cores_hosts(hosts):
     """Get the number of cores of a list of given hosts
 
@@ -29,10 +100,16 @@ def get_cores_hosts(hosts):
     """
 
     n_cores_hosts = dict()
+    try:
+        hosts_attributes = get_hosts_attributes(hosts)
+    except Exception as e:
+        logger.error('Cannot get the attributes of the hosts from the Grid5000 API')
+        logger.error('Exception: %s' % e, exc_info=True)
+        return n_cores_hosts
     for host in hosts:
         host_name = host.split('.')[0]
         try:
-            n_cores_hosts[host] = get_host_attributes(host_name)['architecture']['nb_cores']
+            n_cores_hosts[host] = hosts_attributes[host]['architecture']['nb_cores']
             logger.info('Number of cores of [%s] = %s' % (host_name, n_cores_hosts[host]))
         except Exception as e:
             logger.error('Cannot get number of cores from host [%s]' % host_name)
@@ -137,7 +214,7 @@ def create_combs_queue(result_dir, parameters):
     return sweeper
 
 
-def create_combination_dir(comb, result_dir):
+def create_combination_dir(comb, result_dir, is_clean=True):
     """Create the directory to save result for a specific combination
 
     Parameters
@@ -150,6 +227,9 @@ def create_combination_dir(comb, result_dir):
     result_dir: str
         the path to the directory to store the result on the local node
 
+    is_clean: bool
+        remove the existing files if the directory already exists
+
     Returns
     -------
     str
@@ -160,7 +240,7 @@ def create_combination_dir(comb, result_dir):
     comb_dir = os.path.join(result_dir, utils.slugify(comb))
     if not os.path.exists(comb_dir):
         os.mkdir(comb_dir)
-    else:
+    elif is_clean:
         logger.warning('%s already exists, removing existing files' % comb_dir)
         for f in os.listdir(comb_dir):
             try:
@@ -171,9 +251,12 @@ def create_combination_dir(comb, result_dir):
     return comb_dir
 
 
-def get_results(comb, hosts, remote_result_files, local_result_dir):
+def get_results(comb, hosts, remote_result_files, local_result_dir, compressor='zstd', bandwidth=None,
+                is_incremental=False):
     """Get all the results files from remote hosts to a local result directory
 
+    The results are compressed on the remote hosts and downloaded from many hosts at the same time.
+
     Parameters
     ----------
     comb: dict
@@ -190,12 +273,30 @@ def get_results(comb, hosts, remote_result_files, local_result_dir):
     local_result_dir: str
         the path to the directory to store the results on the local node
 
+    compressor: str
+        the compression used to transfer the results: 'zstd' or 'gzip'
+
+    bandwidth: int
+        the total bandwidth cap in bytes per second to download the results, no cap if None
+
+    is_incremental: bool
+        keep the existing results of this combination and only download new or changed files,
+        e.g. to re-run a cancelled combination or to collect periodic snapshots during a long run
+
     """
+    if is_incremental:
+        comb_dir = create_combination_dir(comb, local_result_dir, is_clean=False)
+        sync_files(hosts=hosts,
+                   remote_paths=remote_result_files,
+                   local_dir=comb_dir,
+                   bandwidth=bandwidth)
+        return
     comb_dir = create_combination_dir(comb, local_result_dir)
-    getput_file(hosts=hosts,
-                file_paths=remote_result_files,
-                dest_location=comb_dir,
-                action='get')
+    get_compressed_files(hosts=hosts,
+                         remote_paths=remote_result_files,
+                         local_dir=comb_dir,
+                         compressor=compressor,
+                         bandwidth=bandwidth)
 
 
 def is_job_alive(oar_job_ids):
@@ -1,5 +1,6 @@
 from .g5k_provisioner import g5k_provisioner
 from .azure_provisioner import azure_provisioner
+from .image_baker import image_baker
 from cloudal.utils import get_logger
 
 logger = get_logger()
@@ -14,3 +15,5 @@ try:
     from .gke_provisioner import gke_provisioner
 except ImportError:
     logger.warning('Missing dependencies to use GKE provisioner')
+
+from .engine import provisioning_engine
@@ -1,20 +1,57 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from cloudal.provisioner.provisioning import cloud_provisioning
 from cloudal.utils import get_logger
 
 from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider
 from libcloud.compute.base import NodeAuthSSHKey
+from libcloud.compute.drivers.azure_arm import AzureSubnet
+from libcloud.common.exceptions import BaseHTTPError
 
 logger = get_logger()
 
+# the number of nodes that are created at the same time
+MAX_CREATE_WORKERS = 5
+# the number of attempts to create a node when Azure throttles the requests
+MAX_CREATE_RETRIES = 6
+# the initial and maximum backoff delays (in seconds) after a throttled request
+BACKOFF_INITIAL = 5
+BACKOFF_MAX = 120
+# the maximum time (in seconds) to wait for all the nodes to be running
+READY_TIMEOUT = 900
+
+
+def _is_throttling_error(e):
+    """Check whether an Azure API error is transient and the request can be retried later"""
+    if isinstance(e, BaseHTTPError) and e.code in (429, 503):
+        return True
+    message = str(e)
+    return 'TooManyRequests' in message or 'RetryableError' in message
+
+
+def _is_quota_error(e):
+    message = str(e)
+    return 'QuotaExceeded' in message or ('OperationNotAllowed' in message and 'quota' in message.lower())
+
 
 class azure_provisioner(cloud_provisioning):
 
     def __init__(self, **kwargs):
         self.config_file_path = kwargs.get('config_file_path')
         self.configs = kwargs.get('configs')
+        self.max_workers = kwargs.get('max_workers', MAX_CREATE_WORKERS)
         self.nodes = list()
         self.hosts = list()
+        # key: node name, value: the error when creating the node
+        self.errors = dict()
+        # libcloud connections are not thread-safe, so each thread uses its own driver
+        self._thread_local = threading.local()
+        # all the workers pause until this time after Azure throttles a request
+        self._throttle_lock = threading.Lock()
+        self._throttle_until = 0
 
         if self.configs and isinstance(self.configs, dict):
             logger.debug("Use configs instead of config file")
@@ -39,71 +76,156 @@ class azure_provisioner(cloud_provisioning):
                      secret=secret)
         return driver
 
-    def make_reservation(self):
-        logger.info("Starting provisioning nodes on Azure")
-        driver = self._get_azure_driver()
-
-        with open(self.configs['public_ssh_key_path'], 'r') as fp:
-            auth = NodeAuthSSHKey(fp.read().strip())
-
+    def _get_thread_driver(self):
+        if getattr(self._thread_local, 'driver', None) is None:
+            self._thread_local.driver = self._get_azure_driver()
+        return self._thread_local.driver
+
+    def _get_catalog(self, driver):
+        """Look up the location, instance type and image of every cluster once
+
+        Returns
+        -------
+        list
+            the list of tuples (cluster, location, instance_type, image)
+        """
+        locations = {location.id: location for location in driver.list_locations()}
+        sizes = dict()
+        images = dict()
+        cluster_specs = list()
         for cluster in self.configs['clusters']:
-            logger.info("Starting provisioning %s nodes on %s" % (n_nodes, location_str))
-
-            n_nodes = cluster['n_nodes']
-
-            # Get location
             location_str = cluster['location']
-            locations = driver.list_locations()
-            location = [location for location in locations if location.id == location_str]
-            if len(location) > 0:
-                location = location[0]
-            else:
-                raise Exception('Wrong location provided')
-
-            # Get instance_type
-            if cluster['instance_type'] is not None:
-                instance_type = cluster['instance_type']
-            else:
-                instance_type = self.configs['instance_type']
-            sizes = driver.list_sizes(location=location)
-            instance_type = [size for size in sizes if size.id == instance_type]
-            if len(instance_type) > 0:
-                instance_type = instance_type[0]
-            else:
-                raise Exception('Wrong instance_type provided')
-
-            # Get image
-            if cluster['image'] is not None:
-                image_id = cluster['image']
-            else:
-                image_id = self.configs['cloud_provider_image']
-            image = driver.get_image(image_id, location=location)
-
-            # Get resource information
-            for resource in self.configs['region_resources']:
-                if resource['location'] == cluster['location']:
-                    resource_group = resource['resource_group']
-                    network = resource['network']
-                    storage_account = resource['storage_account']
-
-            if cluster.get('node_name') is None:
-                cluster['node_name'] = 'node'
-
-            for index in range(n_nodes):
-                node_name = '%s-%s' % (cluster['node_name'], index)
-
-                node = driver.create_node(name=node_name,
+            if location_str not in locations:
+                raise Exception('Wrong location provided: %s' % location_str)
+            location = locations[location_str]
+
+            instance_type_id = cluster.get('instance_type') or self.configs['instance_type']
+            if location_str not in sizes:
+                sizes[location_str] = {size.id: size for size in driver.list_sizes(location=location)}
+            if instance_type_id not in sizes[location_str]:
+                raise Exception('Wrong instance_type provided: %s' % instance_type_id)
+            instance_type = sizes[location_str][instance_type_id]
+
+            image_id = cluster.get('image') or self.configs['cloud_provider_image']
+            if (image_id, location_str) not in images:
+                images[(image_id, location_str)] = driver.get_image(image_id, location=location)
+            image = images[(image_id, location_str)]
+
+            cluster_specs.append((cluster, location, instance_type, image))
+        return cluster_specs
+
+    def _get_region_resources(self, location_str):
+        for resource in self.configs['region_resources']:
+            if resource['location'] == location_str:
+                return resource
+        raise Exception('No region_resources provided for %s' % location_str)
+
+    def _wait_throttle(self):
+        delay = self._throttle_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _create_node(self, node_name, auth, instance_type, image, location, resource):
+        """Create a node with a public IP, retrying with an exponential backoff when Azure throttles the requests"""
+        backoff = BACKOFF_INITIAL
+        for attempt in range(MAX_CREATE_RETRIES):
+            self._wait_throttle()
+            driver = self._get_thread_driver()
+            try:
+                # the default NIC created by create_node has no public IP
+                public_ip = driver.ex_create_public_ip(node_name + '-ip', resource['resource_group'], location)
+                subnet_id = '/subscriptions/%s/resourceGroups/%s/providers/Microsoft.Network/' \
+                            'virtualnetworks/%s/subnets/%s' % (self.configs['subscription_ID'],
+                                                               resource['resource_group'],
+                                                               resource['network'],
+                                                               resource.get('subnet', 'default'))
+                nic = driver.ex_create_network_interface(node_name + '-nic',
+                                                         AzureSubnet(subnet_id, resource.get('subnet', 'default'), {}),
+                                                         resource['resource_group'],
+                                                         location,
+                                                         public_ip=public_ip)
+                return driver.create_node(name=node_name,
                                           auth=auth,
                                           size=instance_type,
                                           image=image,
                                           location=location,
-                                          ex_resource_group=resource_group,
-                                          ex_network=network,
-                                          ex_storage_account=storage_account,
+                                          ex_resource_group=resource['resource_group'],
+                                          ex_nic=nic,
+                                          ex_storage_account=resource['storage_account'],
                                           ex_use_managed_disks=True)
-                self.nodes.append(node)
-                index += 1
+            except Exception as e:
+                if not _is_throttling_error(e) or attempt == MAX_CREATE_RETRIES - 1:
+                    raise
+                delay = max(getattr(e, 'retry_after', 0), backoff)
+                logger.info('Azure throttled the creation of %s, retrying in %s seconds' % (node_name, delay))
+                with self._throttle_lock:
+                    self._throttle_until = max(self._throttle_until, time.time() + delay)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+
+    def make_reservation(self):
+        logger.info("Starting provisioning nodes on Azure")
+        driver = self._get_azure_driver()
+
+        with open(self.configs['public_ssh_key_path'], 'r') as fp:
+            auth = NodeAuthSSHKey(fp.read().strip())
+
+        cluster_specs = self._get_catalog(driver)
+
+        # the nodes of all clusters are created concurrently by a pool of threads
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for cluster, location, instance_type, image in cluster_specs:
+                n_nodes = cluster['n_nodes']
+                location_str = cluster['location']
+                logger.info("Starting provisioning %s nodes on %s" % (n_nodes, location_str))
+                resource = self._get_region_resources(location_str)
+
+                if cluster.get('node_name') is None:
+                    cluster['node_name'] = 'node'
+
+                for index in range(n_nodes):
+                    node_name = '%s-%s' % (cluster['node_name'], index)
+                    future = executor.submit(self._create_node, node_name, auth,
+                                             instance_type, image, location, resource)
+                    futures[future] = node_name
+
+            for future in as_completed(futures):
+                node_name = futures[future]
+                try:
+                    self.nodes.append(future.result())
+                except Exception as e:
+                    if _is_quota_error(e):
+                        logger.error('Cannot create %s, the quota of the subscription is exceeded: %s' %
+                                     (node_name, e))
+                    else:
+                        logger.error('Cannot create %s: %s' % (node_name, e))
+                    self.errors[node_name] = str(e)
+        if self.errors:
+            logger.error('Failed to create %s/%s nodes: %s' % (len(self.errors), len(futures),
+                                                               ', '.join(sorted(self.errors))))
         logger.info("Finish provisioning nodes on Azure\n")
+        return driver
+
+    def _wait_hosts_up(self, driver):
+        logger.info('Waiting for all hosts are up')
+        try:
+            nodes_up = [node for node, _ in driver.wait_until_running(self.nodes, timeout=READY_TIMEOUT)]
+        except Exception as e:
+            logger.error('Not all hosts are up: %s' % e)
+            return
+        logger.info('All reserved hosts are up')
+        self.nodes = nodes_up
+
+    def get_resources(self):
+        """Retriving the public IPs of the list of provisioned hosts
+        """
+        logger.info("Retriving the public IPs of all nodes on Azure")
+        for node in self.nodes:
+            if len(node.public_ips) > 0:
+                self.hosts.append(node.public_ips[0])
+        logger.info("Finish retriving the public IPs\n")
 
     def provisioning(self):
-        self.make_reservation()
+        driver = self.make_reservation()
+        self._wait_hosts_up(driver)
+        self.get_resources()
@@ -0,0 +1,150 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cloudal.utils import get_logger
+
+logger = get_logger()
+
+# the initial and maximum delays (in seconds) before retrying a failed step
+BACKOFF_INITIAL = 30
+BACKOFF_MAX = 300
+# the name of the provisioning() argument that receives each resource as soon as it is ready
+READY_CALLBACKS = {'gcp': 'on_host_ready',
+                   'gke': 'on_cluster_ready'}
+
+
+def _get_provisioner_class(provider):
+    # the provisioners are imported lazily so that a plan only needs the dependencies of its providers
+    from cloudal import provisioner
+    provisioner_class = getattr(provisioner, '%s_provisioner' % provider, None)
+    if provisioner_class is None:
+        raise Exception('Missing dependencies to use %s provisioner' % provider)
+    return provisioner_class
+
+
+class provisioning_engine(object):
+    """Provision the resources of several providers in parallel from a declarative plan
+
+    Each step of the plan describes the desired resources on one provider (the same configs
+    as the provisioner of that provider). The provisioners reuse the resources that already exist,
+    so running a plan again only creates the missing resources.
+
+    Example of a plan for a hybrid experiment:
+        [{'name': 'antidote', 'provider': 'gke', 'configs': configs_gke},
+         {'name': 'elmerfs', 'provider': 'gcp', 'configs': configs_gcp, 'retries': 2}]
+    """
+
+    def __init__(self, plan, is_continue=False):
+        """
+        Parameters
+        ----------
+        plan: list
+            the list of steps, a step is a dict with the following keys:
+                name: str, the name of the step
+                provider: str, 'g5k', 'gcp', 'azure' or 'gke'
+                configs: dict, the provisioning configs of the provider
+                kwargs: dict, optional, other arguments of the provisioner (e.g. oar_job_ids)
+                retries: int, optional, the number of retries of the step after a failure (default 0)
+
+        is_continue: bool
+            if False, raise an exception when a step fails after all its retries
+        """
+        self.plan = plan
+        self.is_continue = is_continue
+        self.listeners = list()
+        self._listeners_lock = threading.Lock()
+        # key: step name, value: the provisioner of the step
+        self.provisioners = dict()
+        # key: step name, value: the error of the failed step
+        self.errors = dict()
+
+        names = [step['name'] for step in plan]
+        if len(set(names)) != len(names):
+            raise ValueError('The names of the steps in the plan must be unique')
+        for step in plan:
+            _get_provisioner_class(step['provider'])
+
+    def add_listener(self, callback):
+        """Register a function that receives the progress events
+
+        An event is a dict with the keys: time, step, provider, status and resource.
+        The status is one of: started, ready, retrying, finished, failed.
+        The resource is a host address or a cluster for the ready status, else None.
+        """
+        self.listeners.append(callback)
+
+    def _emit(self, step, status, resource=None, message=None):
+        event = {'time': time.time(),
+                 'step': step['name'],
+                 'provider': step['provider'],
+                 'status': status,
+                 'resource': resource}
+        if message:
+            logger.info('[%s] %s: %s' % (step['name'], status, message))
+        # the events are sent from the threads of the steps
+        with self._listeners_lock:
+            for callback in self.listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    logger.error('Exception in the progress listener: %s' % e, exc_info=True)
+
+    def _run_step(self, step):
+        """Provision the resources of a step, retrying with an exponential backoff after a failure"""
+        backoff = BACKOFF_INITIAL
+        retries = step.get('retries', 0)
+        provisioner_class = _get_provisioner_class(step['provider'])
+        for attempt in range(retries + 1):
+            start = time.time()
+            self._emit(step, 'started', message='provisioning on %s' % step['provider'])
+            try:
+                provisioner = provisioner_class(configs=step['configs'], **step.get('kwargs', dict()))
+                kwargs = dict()
+                if step['provider'] in READY_CALLBACKS:
+                    kwargs[READY_CALLBACKS[step['provider']]] = lambda resource: self._emit(step, 'ready', resource)
+                provisioner.provisioning(**kwargs)
+            except (Exception, SystemExit) as e:
+                error = str(e) or e.__class__.__name__
+                if isinstance(e, SystemExit):
+                    # the provisioners call exit() on unrecoverable errors, which must not stop the other steps
+                    self._emit(step, 'failed', message=error)
+                    raise Exception('%s provisioner exited' % step['provider']) from e
+                if attempt == retries:
+                    self._emit(step, 'failed', message=error)
+                    raise
+                self._emit(step, 'retrying', message='%s, retrying in %s seconds' % (error, backoff))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+            self._emit(step, 'finished', message='done in %.1f seconds' % (time.time() - start))
+            return provisioner
+
+    def run(self):
+        """Run all the steps of the plan in parallel
+
+        Returns
+        -------
+        dict
+            key: step name, value: the provisioner of the step,
+            which contains the provisioned resources (e.g. hosts, clusters)
+        """
+        if not self.plan:
+            return self.provisioners
+        logger.info('Provisioning %s steps in parallel: %s' %
+                    (len(self.plan), ', '.join('%s (%s)' % (step['name'], step['provider']) for step in self.plan)))
+        first_error = None
+        with ThreadPoolExecutor(max_workers=len(self.plan)) as executor:
+            futures = {executor.submit(self._run_step, step): step for step in self.plan}
+            for future in as_completed(futures):
+                step = futures[future]
+                try:
+                    self.provisioners[step['name']] = future.result()
+                except Exception as e:
+                    logger.error('Provisioning step %s failed' % step['name'], exc_info=True)
+                    self.errors[step['name']] = str(e)
+                    first_error = first_error or e
+        if self.errors and not self.is_continue:
+            raise Exception('Provisioning failed for: %s' %
+                            ', '.join('%s (%s)' % (name, error) for name, error in self.errors.items())) from first_error
+        return self.provisioners
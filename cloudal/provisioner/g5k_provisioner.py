@@ -1,22 +1,28 @@
+import os
 import sys
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 
 from humanfriendly.terminal import message
 
 from cloudal.provisioner.provisioning import cloud_provisioning
-from cloudal.utils import get_remote_executor, get_logger, parse_config_file
+from cloudal.provisioner.g5k_slot_finder import g5k_slot_finder, MAX_PLANNING_HORIZON
+from cloudal.utils import (
+    get_taktuk_executor, is_taktuk_fanout, disable_taktuk, get_logger, parse_config_file, clear_host_facts,
+    read_cache_file, write_cache_file
+)
 
 from execo import format_date, Host
 # from execo.config import default_connection_params
 from execo.time_utils import timedelta_to_seconds, get_unixts
 from execo_g5k import (
     oarsub, wait_oar_job_start, get_oar_job_nodes, get_oar_job_subnets, get_oar_job_kavlan,
-    deploy, Deployment
+    deploy, Deployment, OarSubmission
 )
-from execo_g5k.planning import get_planning, compute_slots, get_jobs_specs
+from execo_g5k.planning import get_jobs_specs
 from execo_g5k.utils import hosts_list
-from execo_g5k.api_utils import canonical_host_name
+from execo_g5k.api_utils import canonical_host_name, get_host_site, get_host_cluster
 from execo_g5k.oar import get_oar_job_info, oardel
 
 
@@ -25,6 +31,12 @@ logger = get_logger()
 # default_connection_params['user'] = 'root'
 
 MAX_RETRY_DEPLOY = 10
+# the maximum time (in seconds) to wait for the replacement nodes to be available
+REPLACEMENT_TIMEOUT = 600
+# the number of candidate slots shown when looking for a slot
+MAX_CANDIDATE_SLOTS = 3
+# the directory (in the cloudal cache directory) of the persisted inventories of the reservations
+INVENTORY_DIR = 'inventory'
 
 
 class g5k_provisioner(cloud_provisioning):
@@ -38,15 +50,27 @@ class g5k_provisioner(cloud_provisioning):
         self.configs = kwargs.get('configs')
         self.is_reservation = kwargs.get('is_reservation')
         self.no_deploy_os = kwargs.get('no_deploy_os')
+        # redeploy or replace only the failed hosts instead of making a whole new reservation
+        self.partial_recovery = kwargs.get('partial_recovery', True)
+        # the maximum time (in seconds) to wait for the resources of all sites, no timeout if None
+        self.resources_timeout = kwargs.get('resources_timeout')
+        # the number of hosts from which the hosts are prepared for TakTuk, cloudal.utils.TAKTUK_THRESHOLD if None,
+        # it has to match the taktuk_threshold given to execute_cmd and getput_file
+        self.taktuk_threshold = kwargs.get('taktuk_threshold')
         self.job_name = job_name
 
         self.max_deploy = MAX_RETRY_DEPLOY
+        self.slot_finder = None
 
         """self.oar_result containts the list of tuples (oar_job_id, site_name)
         that identifies the reservation on each site,
         which can be retrieved from the command line arguments or from make_reservation()
         """
         self.oar_result = list()
+        """self.inventory contains the resources discovered for the reservation,
+        it is persisted on the local disk so that it can be reused when the same oar_job_ids are given
+        """
+        self.inventory = None
         """
         TODO:
             + write function to check all nodes in a job is alive
@@ -54,17 +78,19 @@ class g5k_provisioner(cloud_provisioning):
               -> make replacement reservation or cancel program or ignore
         """
         if self.oar_job_ids is not None:
-            logger.info('Checking the given oar_job_id is valid or not')
             for each in self.oar_job_ids.split(','):
                 site_name, oar_job_id = each.split(':')
-                oar_job_id = int(oar_job_id)
-                # check validity of oar_job_id
-                job_info = get_oar_job_info(oar_job_id=oar_job_id, frontend=site_name)
-                if job_info is None or len(job_info) == 0:
-                    logger.error("Job id: %s in %s is not a valid Grid5000 oar_job_id" % (oar_job_id, site_name))
-                    logger.error("Please rerun the script with a correct oar_job_id")
-                    exit()
                 self.oar_result.append((int(oar_job_id), str(site_name)))
+            self._load_inventory()
+            if self.inventory is None:
+                logger.info('Checking the given oar_job_id is valid or not')
+                for oar_job_id, site_name in self.oar_result:
+                    # check validity of oar_job_id
+                    job_info = get_oar_job_info(oar_job_id=oar_job_id, frontend=site_name)
+                    if job_info is None or len(job_info) == 0:
+                        logger.error("Job id: %s in %s is not a valid Grid5000 oar_job_id" % (oar_job_id, site_name))
+                        logger.error("Please rerun the script with a correct oar_job_id")
+                        exit()
             if self.config_file_path and not self.configs:
                 self.configs = parse_config_file(self.config_file_path)
             return
@@ -80,42 +106,95 @@ class g5k_provisioner(cloud_provisioning):
         self.clusters = {each['cluster']: each['n_nodes']
                          for each in self.configs['clusters']}
 
-    def _get_nodes(self, starttime, endtime):
+    def _get_inventory_name(self):
+        jobs = '_'.join('%s-%s' % (site, oar_job_id) for oar_job_id, site in sorted(self.oar_result))
+        return os.path.join(INVENTORY_DIR, 'g5k_%s.json' % jobs)
+
+    def _load_inventory(self):
+        """Load the persisted inventory of the current reservation if it is still valid
+
+        The inventory is valid until the end of the reservation and while all its jobs
+        are running or waiting, which costs one oarstat per job instead of the whole resources discovery.
+        """
+        self.inventory_name = self._get_inventory_name()
+        inventory = read_cache_file(self.inventory_name)
+        if inventory is None:
+            return
+        if inventory['end_date'] <= time.time():
+            logger.info('The persisted inventory of the reservation is expired')
+            return
+        for oar_job_id, site in inventory['oar_result']:
+            state = get_oar_job_info(oar_job_id=oar_job_id, frontend=site).get('state')
+            if state not in ('Running', 'Waiting'):
+                logger.info('Job %s on %s is %s, discarding the persisted inventory' % (oar_job_id, site, state))
+                return
+        logger.info('Using the persisted inventory of the reservation')
+        self.inventory = inventory
+        self.oar_result = [(oar_job_id, site) for oar_job_id, site in inventory['oar_result']]
+
+    def save_inventory(self):
+        """Persist the inventory of the current reservation on the local disk"""
+        if self.inventory is None:
+            return
+        self.inventory['oar_result'] = self.oar_result
+        self.inventory['resources'] = self.resources
+        self.inventory['hosts'] = self.hosts
+        write_cache_file(self.inventory_name, self.inventory)
+
+    def set_inventory_info(self, key, value):
+        """Store an information about the provisioned resources (e.g. the kubernetes labels of the hosts)
+        in the persisted inventory
+
+        Parameters
+        ----------
+        key: str
+            the name of the information
+
+        value: object
+            a JSON serializable value
+        """
+        if self.inventory is None:
+            return
+        self.inventory['extra'][key] = value
+        self.save_inventory()
+
+    def get_inventory_info(self, key, default=None):
+        """Get an information about the provisioned resources stored in the persisted inventory"""
+        if self.inventory is None:
+            return default
+        return self.inventory['extra'].get(key, default)
+
+    def _get_nodes(self, starttime):
         """ return the nearest slot (startdate) that has enough available nodes
         to perform the client's actions
 
         Parameters
         ----------
-        starttime: str
-            the time to start the reservation
-
-        endtime: str
-            the time to stop the reservation
+        starttime: int
+            the earliest time to start the reservation
 
         Returns
         -------
-        str
+        int
         the start time of the reservation
         """
-
-        planning = get_planning(elements=self.clusters.keys(),
-                                starttime=starttime,
-                                endtime=endtime,
-                                out_of_chart=self.out_of_chart)
-        slots = compute_slots(planning, self.configs['walltime'])
-        startdate = None
-        for slot in slots:
-            is_enough_nodes = True
-            for cluster_name, n_nodes in self.clusters.items():
-                if slot[2][cluster_name] < n_nodes:
-                    is_enough_nodes = False
-                    break
-            if is_enough_nodes:
-                startdate = slot[0]
-                break
-        if startdate is not None:
-            logger.info('A slot is found for your request at %s' % format_date(startdate))
-
+        if self.slot_finder is None:
+            self.slot_finder = g5k_slot_finder(self.clusters.keys(), out_of_chart=self.out_of_chart)
+        walltime = self.configs['walltime']
+        slots = self.slot_finder.find_slots(self.clusters, walltime, starttime, max_slots=MAX_CANDIDATE_SLOTS)
+        if len(slots) == 0:
+            return None
+        startdate = slots[0][0]
+        logger.info('A slot is found for your request at %s' % format_date(startdate))
+
+        message = 'Candidate slots:'
+        for slot_start, n_free_nodes in slots:
+            message += '\n%s: %s' % (format_date(slot_start), n_free_nodes)
+        logger.debug(message)
+        for slot_start, cluster, other_cluster in self.slot_finder.find_substitutions(
+                self.clusters, walltime, starttime):
+            logger.info('Using %s instead of %s would start at %s' %
+                        (other_cluster, cluster, format_date(slot_start)))
         return startdate
 
     def make_reservation(self):
@@ -135,10 +214,13 @@ class g5k_provisioner(cloud_provisioning):
             logger.info(message)
             message = "The list of hosts:"
             for job_id, site in self.oar_result:
-                hosts = get_oar_job_nodes(oar_job_id=job_id, frontend=site)
+                if self.inventory is not None:
+                    hosts = self.inventory['resources'][site]['hosts']
+                else:
+                    hosts = [host.address for host in get_oar_job_nodes(oar_job_id=job_id, frontend=site)]
                 message += "\n--- %s: %s nodes ---" % (site, len(hosts))
                 for host in hosts:
-                    message += "\n%s" % (host.address)
+                    message += "\n%s" % host
             logger.info(message)
             return
 
@@ -157,22 +239,12 @@ class g5k_provisioner(cloud_provisioning):
             self.configs['starttime'] = int(time.time() + timedelta_to_seconds(datetime.timedelta(minutes=1)))
 
         starttime = int(get_unixts(self.configs['starttime']))
-        endtime = int(
-            starttime + timedelta_to_seconds(datetime.timedelta(days=3, minutes=1)))
-        startdate = self._get_nodes(starttime, endtime)
-
-        while startdate is None:
-            logger.info('No enough nodes found between %s and %s, ' +
-                        '\nIncreasing the window time....', format_date(starttime), format_date(endtime))
-            starttime = endtime
-            endtime = int(
-                starttime + timedelta_to_seconds(datetime.timedelta(days=3, minutes=1)))
-
-            startdate = self._get_nodes(starttime, endtime)
-            if starttime > int(self.configs['starttime'] + timedelta_to_seconds(datetime.timedelta(weeks=6))):
-                logger.error(
-                    'What a pity! There is no slot which satisfies your request until %s :(' % format_date(endtime))
-                exit()
+        startdate = self._get_nodes(starttime)
+        if startdate is None:
+            logger.error(
+                'What a pity! There is no slot which satisfies your request until %s :(' %
+                format_date(starttime + MAX_PLANNING_HORIZON))
+            exit()
 
         jobs_specs = get_jobs_specs(self.clusters, name=self.job_name)
         for job_spec, site_name in jobs_specs:
@@ -199,40 +271,147 @@ class g5k_provisioner(cloud_provisioning):
         """Retrieve the hosts address list and (ip, mac) list from a list of oar_result and
         return the resources which is a dict needed by g5k_provisioner
         """
+        if self.inventory is not None:
+            self.resources = self.inventory['resources']
+            self.hosts = self.inventory['hosts']
+            return
+
         logger.info("Getting resources specs")
         self.resources = dict()
         self.hosts = list()
 
-        for oar_job_id, site in self.oar_result:
-            logger.info('Waiting for the reserved nodes on %s to be up' % site)
-            if not wait_oar_job_start(oar_job_id, site):
-                logger.error('The reserved resources cannot be used.\nThe program is terminated.')
-                exit()
-
-        for oar_job_id, site in self.oar_result:
-            logger.info('Retrieving resource information on %s' % site)
-            logger.debug('Retrieving hosts')
-            hosts = [host.address for host in get_oar_job_nodes(
-                oar_job_id, site)]
-
-            logger.debug('Retrieving subnet')
-            ip_mac, _ = get_oar_job_subnets(oar_job_id, site)
-            kavlan = None
-            if len(ip_mac) == 0:
-                logger.debug('Retrieving kavlan')
-                kavlan = get_oar_job_kavlan(oar_job_id, site)
-                if kavlan:
-                    ip_mac = self.get_kavlan_ip_mac(kavlan, site)
-            self.resources[site] = {'hosts': hosts,
-                                    'ip_mac': ip_mac,
-                                    'kavlan': kavlan}
+        # the per-site OAR/API calls are run concurrently within a shared deadline
+        if self.resources_timeout is not None:
+            deadline = time.time() + self.resources_timeout
+        else:
+            deadline = None
+        end_dates = list()
+        failed_sites = list()
+        executor = ThreadPoolExecutor(max_workers=len(self.oar_result))
+        futures = {executor.submit(self._get_site_resources, oar_job_id, site, deadline): site
+                   for oar_job_id, site in self.oar_result}
+        try:
+            for future in as_completed(futures, timeout=self.resources_timeout):
+                site = futures[future]
+                try:
+                    self.resources[site], end_date = future.result()
+                    end_dates.append(end_date)
+                    logger.info('Retrieved %s hosts on %s' % (len(self.resources[site]['hosts']), site))
+                except Exception as e:
+                    logger.error('Cannot retrieve the resources on %s: %s' % (site, e))
+                    failed_sites.append(site)
+        except TimeoutError:
+            failed_sites += [site for future, site in futures.items() if not future.done()]
+            logger.error('Timeout after %s seconds while retrieving the resources on: %s' %
+                         (self.resources_timeout, ', '.join(failed_sites)))
+        executor.shutdown(wait=False)
+
+        if failed_sites:
+            message = 'The reserved resources cannot be used.'
+            for site, resource in self.resources.items():
+                message += '\n%s: %s hosts are ready' % (site, len(resource['hosts']))
+            for site in failed_sites:
+                message += '\n%s: FAILED' % site
+            logger.error(message + '\nThe program is terminated.')
+            exit()
 
         for site, resource in self.resources.items():
             self.hosts += resource['hosts']
 
-    def _launch_kadeploy(self, max_tries=10, check_deploy=True):
-        """Create an execo_g5k.Deployment object, launch the deployment and
+        self.inventory_name = self._get_inventory_name()
+        self.inventory = {'end_date': min(end_dates),
+                          'extra': dict()}
+        self.save_inventory()
+
+    def _get_site_resources(self, oar_job_id, site, deadline=None):
+        """Wait for the reservation on a site to start and retrieve its resources
+
+        Returns
+        -------
+        tuple
+            (dict of hosts, ip_mac and kavlan of the site, the end date of the reservation)
+        """
+        logger.info('Waiting for the reserved nodes on %s to be up' % site)
+        timeout = max(deadline - time.time(), 0) if deadline is not None else None
+        if not wait_oar_job_start(oar_job_id, site, timeout=timeout):
+            raise Exception('the reserved nodes are not up')
+
+        logger.info('Retrieving resource information on %s' % site)
+        logger.debug('Retrieving hosts')
+        hosts = [host.address for host in get_oar_job_nodes(oar_job_id, site)]
+
+        logger.debug('Retrieving subnet')
+        ip_mac, _ = get_oar_job_subnets(oar_job_id, site)
+        kavlan = None
+        if len(ip_mac) == 0:
+            logger.debug('Retrieving kavlan')
+            kavlan = get_oar_job_kavlan(oar_job_id, site)
+            if kavlan:
+                ip_mac = self.get_kavlan_ip_mac(kavlan, site)
+
+        job_info = get_oar_job_info(oar_job_id, site)
+        end_date = job_info['start_date'] + job_info['walltime']
+        return {'hosts': hosts, 'ip_mac': ip_mac, 'kavlan': kavlan}, end_date
+
+    def _get_hosts_by_site(self, hosts):
+        """Group the given hosts by their Grid5000 site
+
+        Parameters
+        ----------
+        hosts: list
+            the list of host addresses
+
+        Returns
+        -------
+        dict
+            key: site name, value: list of host addresses
+        """
+        host_sites = dict()
+        for site, resource in getattr(self, 'resources', dict()).items():
+            for host in resource['hosts']:
+                host_sites[host] = site
+        hosts_by_site = dict()
+        for host in hosts:
+            site = host_sites.get(host)
+            if site is None:
+                # host address has the form of <node>.<site>.grid5000.fr
+                site = host.split('.')[1] if host.count('.') >= 2 else get_host_site(host)
+            hosts_by_site.setdefault(site, list()).append(host)
+        return hosts_by_site
+
+    def _deploy_site(self, site, hosts, max_tries, check_deploy, stdout, stderr):
+        """Run kadeploy on the hosts of one site and
+        return a tuple (deployed_hosts, undeployed_hosts, duration)
+        """
+        start = time.time()
+        deployment = Deployment(hosts=[Host(canonical_host_name(host)) for host in hosts],
+                                env_file=self.configs['custom_image'],
+                                env_name=self.configs['cloud_provider_image'])
+        try:
+            deployed_hosts, undeployed_hosts = deploy(deployment,
+                                                      stdout_handlers=stdout,
+                                                      stderr_handlers=stderr,
+                                                      num_tries=max_tries,
+                                                      check_deployed_command=check_deploy)
+        except Exception as e:
+            logger.error('Deploying hosts on %s failed: %s' % (site, e))
+            deployed_hosts, undeployed_hosts = list(), hosts
+        return list(deployed_hosts), list(undeployed_hosts), time.time() - start
+
+    def _launch_kadeploy(self, max_tries=10, check_deploy=True, hosts=None):
+        """Launch one kadeploy per site concurrently and
         return a tuple (deployed_hosts, undeployed_hosts)
+
+        Parameters
+        ----------
+        max_tries: int
+            the number of deployment tries of kadeploy on each site
+
+        check_deploy: bool
+            check whether the hosts are already deployed before running kadeploy
+
+        hosts: list
+            the list of hosts to deploy, all the provisioned hosts by default
         """
 
         # if the provisioner has oar_job_ids and no config_file_path
@@ -242,17 +421,20 @@ class g5k_provisioner(cloud_provisioning):
                 self.hosts), hosts_list(self.hosts, separator='\n'))
             return
 
-        logger.info('Deploying %s hosts \n%s', len(self.hosts),
-                    hosts_list(self.hosts, separator='\n'))
-        try:
-            deployment = Deployment(hosts=[Host(canonical_host_name(host))
-                                           for host in self.hosts],
-                                    env_file=self.configs['custom_image'],
-                                    env_name=self.configs['cloud_provider_image'])
-        except ValueError:
+        if (self.configs['custom_image'] is None) == (self.configs['cloud_provider_image'] is None):
             logger.error(
                 "Please put in the config file either custom_image or cloud_provider_image.")
             exit()
+
+        if hosts is None:
+            hosts = self.hosts
+        # the hosts which are still deployed from a previous run are skipped by the
+        # check_deployed_command of deploy(), so they do not need to be tracked in the inventory
+        if len(hosts) == 0:
+            return list(), list()
+
+        logger.info('Deploying %s hosts \n%s', len(hosts),
+                    hosts_list(hosts, separator='\n'))
         # user=self.env_user,
         # vlan=self.kavlan)
 
@@ -264,15 +446,26 @@ class g5k_provisioner(cloud_provisioning):
             stdout = None
             stderr = None
 
-        # deploy() function will iterate through each frontend to run kadeploy
-        # so that the deployment hosts will be performed sequentially site after site
-        deployed_hosts, undeployed_hosts = deploy(deployment,
-                                                  stdout_handlers=stdout,
-                                                  stderr_handlers=stderr,
-                                                  num_tries=max_tries,
-                                                  check_deployed_command=check_deploy)
-        deployed_hosts = list(deployed_hosts)
-        undeployed_hosts = list(undeployed_hosts)
+        # deploy() function iterates through each frontend to run kadeploy,
+        # so one deploy() is launched per site to deploy all the sites at the same time
+        hosts_by_site = self._get_hosts_by_site(hosts)
+        if not hosts_by_site:
+            return list(), list()
+        deployed_hosts = list()
+        undeployed_hosts = list()
+        with ThreadPoolExecutor(max_workers=len(hosts_by_site)) as executor:
+            futures = {executor.submit(self._deploy_site, site, site_hosts,
+                                       max_tries, check_deploy, stdout, stderr): site
+                       for site, site_hosts in hosts_by_site.items()}
+            for future in as_completed(futures):
+                site = futures[future]
+                site_deployed, site_undeployed, duration = future.result()
+                logger.info('Deployed %s/%s hosts on %s in %.1f seconds' % (
+                    len(site_deployed), len(hosts_by_site[site]), site, duration))
+                deployed_hosts += site_deployed
+                undeployed_hosts += site_undeployed
+        # the facts collected on the hosts before are outdated after a new OS deployment
+        clear_host_facts(hosts)
         # # Renaming hosts if a kavlan is used
         # if self.kavlan:
         #     for i, host in enumerate(deployed_hosts):
@@ -285,20 +478,124 @@ class g5k_provisioner(cloud_provisioning):
 
         return deployed_hosts, undeployed_hosts
 
+    def _remove_hosts(self, hosts):
+        """Remove the given hosts from self.hosts and self.resources"""
+        hosts = set(canonical_host_name(host) for host in hosts)
+        self.hosts = [host for host in self.hosts if canonical_host_name(host) not in hosts]
+        for site, resource in self.resources.items():
+            resource['hosts'] = [host for host in resource['hosts'] if canonical_host_name(host) not in hosts]
+
+    def _reserve_replacement_hosts(self, failed_hosts):
+        """Reserve new nodes on the same clusters to replace the failed hosts
+
+        The replacement reservations last until the end of the current reservation
+        on each site and are added into self.oar_result.
+
+        Parameters
+        ----------
+        failed_hosts: list
+            the list of hosts to replace
+
+        Returns
+        -------
+        replaced_hosts: list
+            the failed hosts that are replaced
+
+        replacement_hosts: list
+            the replacement hosts that are reserved
+        """
+        replaced_hosts = list()
+        replacement_hosts = list()
+        for site, site_failed_hosts in self._get_hosts_by_site(failed_hosts).items():
+            n_nodes_by_cluster = dict()
+            for host in site_failed_hosts:
+                cluster = get_host_cluster(host)
+                n_nodes_by_cluster[cluster] = n_nodes_by_cluster.get(cluster, 0) + 1
+
+            end_dates = list()
+            for oar_job_id, job_site in self.oar_result:
+                if job_site == site:
+                    job_info = get_oar_job_info(oar_job_id, site)
+                    end_dates.append(job_info['start_date'] + job_info['walltime'])
+            walltime = int(max(end_dates) - time.time()) if end_dates else self.configs['walltime']
+            if walltime <= 0:
+                logger.info('The reservation on %s is already finished, no replacement nodes' % site)
+                continue
+
+            # single quotes: the resources are already wrapped in double quotes by oarsub
+            resources = '+'.join("{cluster='%s'}/nodes=%s" % (cluster, n_nodes)
+                                 for cluster, n_nodes in n_nodes_by_cluster.items())
+            logger.info('Reserving replacement nodes on %s: %s' % (site, resources))
+            job_spec = OarSubmission(resources=resources,
+                                     walltime=walltime,
+                                     name=self.job_name,
+                                     additional_options='-t deploy')
+            [(oar_job_id, _)] = oarsub([(job_spec, site)])
+            if oar_job_id is None:
+                logger.info('Reserving replacement nodes on %s FAILED' % site)
+                continue
+            if not wait_oar_job_start(oar_job_id, site, timeout=REPLACEMENT_TIMEOUT):
+                logger.info('The replacement nodes on %s are not available after %s seconds' %
+                            (site, REPLACEMENT_TIMEOUT))
+                oardel([(oar_job_id, site)])
+                continue
+            self.oar_result.append((oar_job_id, site))
+            hosts = [host.address for host in get_oar_job_nodes(oar_job_id, site)]
+            self.resources[site]['hosts'] += hosts
+            self.hosts += hosts
+            replacement_hosts += hosts
+            replaced_hosts += site_failed_hosts
+        return replaced_hosts, replacement_hosts
+
+    def _recover_undeployed_hosts(self, undeployed_hosts):
+        """Try to recover from a partial deployment failure
+
+        First, the undeployed hosts are deployed again. Then, the hosts that still fail
+        are replaced by new nodes on the same clusters, only the replaced hosts are removed
+        from the resources so that the caller can fall back for the others.
+
+        Parameters
+        ----------
+        undeployed_hosts: list
+            the list of hosts that kadeploy failed to deploy
+
+        Returns
+        -------
+        list
+            the list of hosts that are still not deployed after the recovery
+        """
+        logger.info('Redeploying %s failed hosts' % len(undeployed_hosts))
+        _, undeployed_hosts = self._launch_kadeploy(hosts=undeployed_hosts, check_deploy=False)
+        if len(undeployed_hosts) == 0:
+            return undeployed_hosts
+
+        logger.info('Replacing %s hosts that cannot be deployed' % len(undeployed_hosts))
+        replaced_hosts, replacement_hosts = self._reserve_replacement_hosts(undeployed_hosts)
+        self._remove_hosts(replaced_hosts)
+        # the hosts which are not replaced are kept so that the caller can fall back
+        unreplaced_hosts = [host for host in undeployed_hosts if host not in replaced_hosts]
+        if unreplaced_hosts:
+            logger.info('Only %s/%s hosts are replaced' % (len(replaced_hosts), len(undeployed_hosts)))
+        if replacement_hosts:
+            _, undeployed_replacement_hosts = self._launch_kadeploy(hosts=replacement_hosts)
+            unreplaced_hosts += undeployed_replacement_hosts
+        return unreplaced_hosts
+
     def _configure_ssh(self):
-        self.remote_executor = get_remote_executor()
-        if self.remote_executor.remote_tool == 2:
-            # Configuring SSH with precopy of id_rsa and id_rsa.pub keys on all
-            # host to allow TakTuk connection
-            taktuk_conf = ('-s', '-S',
-                           '$HOME/.ssh/id_rsa:$HOME/.ssh/id_rsa,' +
-                           '$HOME/.ssh/id_rsa.pub:$HOME/.ssh')
-        else:
-            taktuk_conf = ('-s', )
-        conf_ssh = self.remote_executor.get_remote('echo "Host *" >> /root/.ssh/config ;' +
-                                                   'echo " StrictHostKeyChecking no" >> /root/.ssh/config; ',
-                                                   self.hosts,
-                                                   connection_params={'taktuk_options': taktuk_conf}).run()
+        # the hosts are reached through a TakTuk tree, so they have to be able to
+        # connect to each other: precopy id_rsa and id_rsa.pub keys on all hosts
+        self.remote_executor = get_taktuk_executor()
+        taktuk_conf = ('-s', '-S',
+                       '$HOME/.ssh/id_rsa:$HOME/.ssh/id_rsa,' +
+                       '$HOME/.ssh/id_rsa.pub:$HOME/.ssh')
+        try:
+            conf_ssh = self.remote_executor.get_remote('echo "Host *" >> /root/.ssh/config ;' +
+                                                       'echo " StrictHostKeyChecking no" >> /root/.ssh/config; ',
+                                                       self.hosts,
+                                                       connection_params={'taktuk_options': taktuk_conf}).run()
+        except Exception as e:
+            # the next commands are performed with SSH from local, which does not need the keys
+            disable_taktuk(e)
 
     def provisioning(self):
         """Provision nodes on Grid5000 based on client's requirements
@@ -315,7 +612,10 @@ class g5k_provisioner(cloud_provisioning):
             n_nodes = sum([len(resource['hosts']) for site, resource in self.resources.items()])
             logger.info('Starting setup on %s hosts' % n_nodes)
             deployed_hosts, undeployed_hosts = self._launch_kadeploy()
-            # self._configure_ssh()
+            if len(undeployed_hosts) > 0 and self.partial_recovery:
+                undeployed_hosts = self._recover_undeployed_hosts(undeployed_hosts)
+            if is_taktuk_fanout(self.hosts, self.taktuk_threshold):
+                self._configure_ssh()
 
             # Retry provisioning again if all reserved hosts are not deployed successfully
             if len(undeployed_hosts) > 0:
@@ -324,10 +624,16 @@ class g5k_provisioner(cloud_provisioning):
                     if self.oar_job_ids is None:
                         logger.info('Deleting the current reservation')
                         oardel(self.oar_result)
+                        # invalidate the persisted inventory of the deleted reservation
+                        if self.inventory is not None:
+                            self.inventory['end_date'] = 0
+                            self.save_inventory()
+                            self.inventory = None
                         time.sleep(60)
                         self.oar_result = list()
                     logger.info('---> Retrying provisioning nodes: attempt #%s' % (MAX_RETRY_DEPLOY - self.max_deploy))
                     self.provisioning()
                 else:
                     raise Exception('Failed to deploy all reserved nodes. Terminate the program.')
+        self.save_inventory()
         logger.info("Finish provisioning nodes\n")
@@ -0,0 +1,199 @@
+import time
+import datetime
+
+from cloudal.utils import get_logger
+
+from execo import format_date
+from execo.time_utils import timedelta_to_seconds
+from execo_g5k.planning import get_planning
+from execo_g5k.api_utils import get_cluster_site
+
+
+logger = get_logger()
+
+# the time period (in seconds) of the planning fetched at once
+PLANNING_HORIZON = int(timedelta_to_seconds(datetime.timedelta(weeks=2)))
+# the maximum time period (in seconds) to look for a slot
+MAX_PLANNING_HORIZON = int(timedelta_to_seconds(datetime.timedelta(weeks=6)))
+# the time (in seconds) that a fetched planning is considered up to date
+PLANNING_TTL = 60
+NON_CLUSTER_ELEMENTS = ('vlans', 'subnets', 'storage')
+
+
+class g5k_slot_finder(object):
+    """Find the slots that have enough available nodes on Grid5000 clusters
+
+    The planning of the sites is fetched once for a wide time period and kept in memory,
+    it is only extended when no slot is found in the current time period.
+    The slots are found with a sweep line over the start times that each free host can accept.
+    """
+
+    def __init__(self, clusters, out_of_chart=False):
+        """
+        Parameters
+        ----------
+        clusters: list
+            the list of cluster names to look for slots
+
+        out_of_chart: bool
+            if True, the days outside weekends are considered busy
+        """
+        self.out_of_chart = out_of_chart
+        self.sites = sorted(set(get_cluster_site(cluster) for cluster in clusters))
+        # key: cluster name, value: dict of {host: list of free intervals}
+        self.planning = dict()
+        self.cluster_sites = dict()
+        self.horizon_start = None
+        self.horizon_end = None
+        self.fetched_at = None
+
+    def _fetch_planning(self, starttime, endtime):
+        logger.debug('Fetching the planning of %s from %s to %s' % (self.sites, starttime, endtime))
+        planning = get_planning(elements=self.sites,
+                                starttime=starttime,
+                                endtime=endtime,
+                                out_of_chart=self.out_of_chart)
+        result = dict()
+        for site, site_planning in planning.items():
+            for cluster, cluster_planning in site_planning.items():
+                if cluster in NON_CLUSTER_ELEMENTS:
+                    continue
+                self.cluster_sites[cluster] = site
+                result[cluster] = {host: list(host_planning['free'])
+                                   for host, host_planning in cluster_planning.items()}
+        return result
+
+    def _extend_planning(self, starttime, endtime):
+        """Make sure that the planning covers the time period [starttime, endtime]"""
+        if (self.fetched_at is None or time.time() - self.fetched_at > PLANNING_TTL
+                or starttime < self.horizon_start):
+            self.planning = self._fetch_planning(starttime, endtime)
+            self.horizon_start, self.horizon_end = starttime, endtime
+            self.fetched_at = time.time()
+            return
+        if endtime <= self.horizon_end:
+            return
+        new_planning = self._fetch_planning(self.horizon_end, endtime)
+        for cluster, hosts in new_planning.items():
+            for host, free_intervals in hosts.items():
+                intervals = self.planning.setdefault(cluster, dict()).setdefault(host, list())
+                # join the free interval that spans over the previous end of the planning
+                if intervals and free_intervals and intervals[-1][1] == free_intervals[0][0]:
+                    intervals[-1] = (intervals[-1][0], free_intervals[0][1])
+                    free_intervals = free_intervals[1:]
+                intervals += free_intervals
+        self.horizon_end = endtime
+
+    def _sweep(self, clusters, walltime, starttime):
+        """Yield the start times at which every cluster has enough free nodes for the walltime
+
+        A free interval (a, b) of a host can accept a job starting at t if a <= t <= b - walltime,
+        so each interval adds one free node on [a, b - walltime]. Sweeping over the sorted bounds
+        gives the number of free nodes of each cluster at every start time that can change it.
+
+        Yields
+        ------
+        tuple
+            (start time, dict of {cluster: number of free nodes})
+        """
+        events = list()
+        for cluster in clusters:
+            for free_intervals in self.planning.get(cluster, dict()).values():
+                for start, end in free_intervals:
+                    start = max(start, starttime)
+                    if end - walltime >= start:
+                        # the nodes are added before checking and removed after checking
+                        events.append((start, 0, cluster))
+                        events.append((end - walltime, 1, cluster))
+        events.sort()
+
+        n_free_nodes = {cluster: 0 for cluster in clusters}
+        i = 0
+        while i < len(events):
+            timestamp = events[i][0]
+            is_added = False
+            while i < len(events) and events[i][0] == timestamp and events[i][1] == 0:
+                n_free_nodes[events[i][2]] += 1
+                is_added = True
+                i += 1
+            if is_added and all(n_free_nodes[cluster] >= n_nodes for cluster, n_nodes in clusters.items()):
+                yield timestamp, dict(n_free_nodes)
+            while i < len(events) and events[i][0] == timestamp:
+                n_free_nodes[events[i][2]] -= 1
+                i += 1
+
+    def find_slots(self, clusters, walltime, starttime, max_slots=1):
+        """Find the earliest slots that have enough available nodes on each cluster
+
+        Parameters
+        ----------
+        clusters: dict
+            key: cluster name, value: the number of nodes required on the cluster
+
+        walltime: int
+            the duration of the reservation in seconds
+
+        starttime: int
+            the earliest start time of the reservation (unix timestamp)
+
+        max_slots: int
+            the maximum number of candidate slots to return
+
+        Returns
+        -------
+        list
+            the list of tuples (start time, dict of {cluster: number of free nodes}),
+            sorted by start time
+        """
+        endtime = starttime + PLANNING_HORIZON
+        while True:
+            self._extend_planning(starttime, endtime)
+            slots = list()
+            for slot in self._sweep(clusters, walltime, starttime):
+                slots.append(slot)
+                if len(slots) >= max_slots:
+                    break
+            # only extend the planning when no slot is found at all
+            if len(slots) > 0 or endtime >= starttime + MAX_PLANNING_HORIZON:
+                return slots
+            logger.info('No enough nodes found until %s, increasing the time window....' %
+                        format_date(endtime))
+            endtime = min(endtime + PLANNING_HORIZON, starttime + MAX_PLANNING_HORIZON)
+
+    def find_substitutions(self, clusters, walltime, starttime):
+        """Find the clusters of the same sites that can replace a requested cluster
+        to get an earlier slot
+
+        Parameters
+        ----------
+        clusters: dict
+            key: cluster name, value: the number of nodes required on the cluster
+
+        walltime: int
+            the duration of the reservation in seconds
+
+        starttime: int
+            the earliest start time of the reservation (unix timestamp)
+
+        Returns
+        -------
+        list
+            the list of tuples (start time, requested cluster, substituted cluster),
+            sorted by start time, that are earlier than the slot of the requested clusters
+        """
+        slots = self.find_slots(clusters, walltime, starttime)
+        earliest = slots[0][0] if slots else None
+        substitutions = list()
+        for cluster, n_nodes in clusters.items():
+            site = self.cluster_sites.get(cluster)
+            for other_cluster, other_site in self.cluster_sites.items():
+                if other_site != site or other_cluster in clusters:
+                    continue
+                candidate = dict(clusters)
+                del candidate[cluster]
+                candidate[other_cluster] = n_nodes
+                for start, _ in self._sweep(candidate, walltime, starttime):
+                    if earliest is None or start < earliest:
+                        substitutions.append((start, cluster, other_cluster))
+                    break
+        return sorted(substitutions)
@@ -1,21 +1,42 @@
 from logging import info
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from libcloud.compute.types import Provider
 from libcloud.compute.providers import get_driver
+from libcloud.compute.drivers.gce import GCENodeImage, GCENodeSize
 
 from cloudal.provisioner.provisioning import cloud_provisioning
-from cloudal.utils import get_logger
+from cloudal.utils import get_logger, rate_limiter, read_cache_file, write_cache_file, is_ssh_ready
 
 logger = get_logger()
 
+# the number of nodes that are created at the same time
+MAX_CREATE_WORKERS = 10
+# the maximum number of create_node calls per second, to stay under the GCE API rate limits
+CREATE_RATE = 5
+# the time to live (in seconds) of the cached catalog of images and instance types
+GCP_CATALOG_TTL = 24 * 3600
+# the maximum time (in seconds) to wait for the nodes to be running and reachable by SSH
+READY_TIMEOUT = 600
+# the interval (in seconds) between two checks of the state of the nodes
+READY_POLL_INTERVAL = 5
+
 
 class gcp_provisioner(cloud_provisioning):
     def __init__(self, **kwargs):
         self.config_file_path = kwargs.get('config_file_path')
         self.configs = kwargs.get('configs')
+        self.max_workers = kwargs.get('max_workers', MAX_CREATE_WORKERS)
         self.nodes = list()
         self.hosts = list()
+        # key: node name, value: the error when creating the node
+        self.errors = dict()
+        self.nodes_not_ready = list()
+        # libcloud connections are not thread-safe, so each thread uses its own driver
+        self._thread_local = threading.local()
 
         if self.configs and isinstance(self.configs, dict):
             logger.debug("Use configs instead of config file")
@@ -40,29 +61,130 @@ class gcp_provisioner(cloud_provisioning):
                         project=PROJECT_ID)
         return driver
 
-    def _get_existed_nodes(self, driver, list_zones):
-        existed_nodes = dict()
-        for zone in list_zones:
-            existed_nodes[zone] = dict()
+    def _get_thread_driver(self):
+        if getattr(self._thread_local, 'driver', None) is None:
+            self._thread_local.driver = self._get_gce_driver()
+        return self._thread_local.driver
+
+    def _create_node(self, limiter, node_name, image, instance_type, metadata, zone):
+        limiter.consume()
+        driver = self._get_thread_driver()
+        return driver.create_node(name=node_name,
+                                  image=image,
+                                  size=instance_type,
+                                  ex_metadata=metadata,
+                                  location=zone)
+
+    def _get_existed_nodes(self, list_zones, executor=None):
+        """List the existing nodes of the given zones concurrently
+
+        Parameters
+        ----------
+        executor: concurrent.futures.ThreadPoolExecutor
+            the pool of threads to list the zones, its threads keep their drivers between calls,
+            a temporary pool is used if None
+
+        Returns
+        -------
+        dict
+            key: zone name, value: dict of {node name: node}
+        """
+        def list_zone_nodes(zone):
+            return self._get_thread_driver().list_nodes(ex_zone=zone)
 
-        for zone in list_zones:
-            nodes = driver.list_nodes(ex_zone=zone)
-            for node in nodes:
-                existed_nodes[zone][node.name] = node
+        list_zones = list(set(list_zones))
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=min(len(list_zones), self.max_workers)) as executor:
+                return self._get_existed_nodes(list_zones, executor)
+        existed_nodes = dict()
+        for zone, nodes in zip(list_zones, executor.map(list_zone_nodes, list_zones)):
+            existed_nodes[zone] = {node.name: node for node in nodes}
         return existed_nodes
 
-    def _wait_hosts_up(self, driver):
+    def _get_catalog_name(self):
+        return os.path.join('gcp', 'catalog_%s.json' % self.configs['project_id'])
+
+    def _get_image(self, driver, catalog, image_name):
+        """Get an image by its name from the cached catalog, or from GCP if it is not cached"""
+        image = catalog['images'].get(image_name)
+        if image is None:
+            node_image = driver.ex_get_image(image_name)
+            if node_image is None:
+                raise Exception('Cannot find the image %s on GCP' % image_name)
+            image = {'id': node_image.id,
+                     'name': node_image.name,
+                     'selfLink': node_image.extra['selfLink']}
+            catalog['images'][image_name] = image
+        return GCENodeImage(image['id'], image['name'], driver, extra={'selfLink': image['selfLink']})
+
+    def _get_size(self, driver, catalog, size_name, zone):
+        """Get an instance type of a zone from the cached catalog, or from GCP if it is not cached"""
+        key = '%s/%s' % (zone, size_name)
+        size = catalog['sizes'].get(key)
+        if size is None:
+            # only look up the instance type in its zone instead of listing the sizes of all zones
+            node_size = driver.ex_get_size(size_name, zone)
+            size = {'id': node_size.id,
+                    'name': node_size.name,
+                    'ram': node_size.ram,
+                    'disk': node_size.disk,
+                    'selfLink': node_size.extra['selfLink']}
+            catalog['sizes'][key] = size
+        return GCENodeSize(size['id'], size['name'], size['ram'], size['disk'], None, None, driver,
+                           extra={'selfLink': size['selfLink']})
+
+    def iter_ready_nodes(self, timeout=READY_TIMEOUT, poll_interval=READY_POLL_INTERVAL):
+        """Yield each provisioned node as soon as it is running and reachable by SSH
+
+        The nodes that are not ready before the timeout are stored in self.nodes_not_ready
+
+        Parameters
+        ----------
+        timeout: int
+            the maximum time to wait for all the nodes in seconds
+
+        poll_interval: int
+            the interval between two checks of the state of the nodes in seconds
+
+        Yields
+        ------
+        libcloud.compute.base.Node
+            a node that is running and accepts SSH connections
+        """
         logger.info('Waiting for all hosts are up')
-        nodes_up = list()
-        r = driver.wait_until_running(self.nodes)
-        for each in r:
-            nodes_up.append(each[0])
-        if len(nodes_up) == len(self.nodes):
-            logger.info('All reserved hosts are up')
-            self.nodes = nodes_up
+        # nodes of different zones can have the same name
+        pending_nodes = {(node.extra['zone'].name, node.name): node for node in self.nodes}
+        checking_nodes = dict()
+        deadline = time.time() + timeout
+        n_zones = len(set(zone for zone, _ in pending_nodes))
+        # the same pools (and so the same drivers) are used for all the polls
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=max(1, min(n_zones, self.max_workers))) as list_executor:
+            while (pending_nodes or checking_nodes) and time.time() < deadline:
+                if pending_nodes:
+                    existed_nodes = self._get_existed_nodes([zone for zone, _ in pending_nodes], list_executor)
+                    for zone, node_name in list(pending_nodes):
+                        node = existed_nodes[zone].get(node_name)
+                        if node is not None and node.state == 'running' and len(node.public_ips) > 0:
+                            del pending_nodes[(zone, node_name)]
+                            future = executor.submit(is_ssh_ready, node.public_ips[0])
+                            checking_nodes[future] = ((zone, node_name), node)
+                if not checking_nodes:
+                    time.sleep(poll_interval)
+                    continue
+                done, _ = wait(checking_nodes, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, node = checking_nodes.pop(future)
+                    if future.result():
+                        yield node
+                    else:
+                        # SSH server is not started yet, check again later
+                        pending_nodes[key] = node
+        self.nodes_not_ready = list(pending_nodes.values()) + [node for _, node in checking_nodes.values()]
+        if self.nodes_not_ready:
+            logger.info('The following hosts are not up: %s' % [node.name for node in self.nodes_not_ready])
         else:
-            hosts_ko = [node.name for node in self.nodes if node not in nodes_up]
-            logger.info('The following hosts are not up: %s' % hosts_ko)
+            logger.info('All reserved hosts are up')
 
     def make_reservation(self):
         driver = self._get_gce_driver()
@@ -70,14 +192,23 @@ class gcp_provisioner(cloud_provisioning):
         list_zones = list()
         for cluster in self.configs['clusters']:
             list_zones.append(cluster['zone'])
-        existed_nodes = self._get_existed_nodes(driver, list_zones)
+        existed_nodes = self._get_existed_nodes(list_zones)
 
-        images = driver.list_images()
-        sizes = driver.list_sizes()
-        if self.configs['cloud_provider_image'] is not None:
-            image = [i for i in images if i.name == self.configs['cloud_provider_image']][0]
-        if self.configs['instance_type'] is not None:
-            instance_type = [s for s in sizes if s.name == self.configs['instance_type']][0]
+        catalog = read_cache_file(self._get_catalog_name(), GCP_CATALOG_TTL) or {'images': dict(), 'sizes': dict()}
+        n_cached = len(catalog['images']) + len(catalog['sizes'])
+        # resolve the image and the instance type of every cluster before creating any node
+        cluster_specs = list()
+        for cluster in self.configs['clusters']:
+            image_name = cluster.get('image') or self.configs.get('cloud_provider_image')
+            instance_type_name = cluster.get('instance_type') or self.configs.get('instance_type')
+            if image_name is None or instance_type_name is None:
+                logger.error('Please put in the config file the image and the instance type of %s' % cluster['zone'])
+                exit()
+            cluster_specs.append((cluster,
+                                  self._get_image(driver, catalog, image_name),
+                                  self._get_size(driver, catalog, instance_type_name, cluster['zone'])))
+        if len(catalog['images']) + len(catalog['sizes']) > n_cached:
+            write_cache_file(self._get_catalog_name(), catalog)
 
         PUBLIC_SSH_KEY_PATH = os.path.expanduser(self.configs['public_ssh_key_path'])
 
@@ -94,24 +225,16 @@ class gcp_provisioner(cloud_provisioning):
         }
 
         logger.info("Starting provisioning nodes on GCP")
-        index = 0
-        for cluster in self.configs['clusters']:
+        # the nodes of all zones are created concurrently by a pool of threads
+        limiter = rate_limiter(CREATE_RATE)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = dict()
+        for cluster, current_image, current_instance_type in cluster_specs:
             if cluster.get('node_name') is None:
                 cluster['node_name'] = 'node'
             n_nodes = cluster['n_nodes']
-            instance_type = cluster['instance_type']
             zone = cluster['zone']
 
-            if cluster['image'] is not None:
-                current_image = cluster['image']
-            else:
-                current_image = image
-
-            if cluster['instance_type'] is not None:
-                current_instance_type = cluster['instance_type']
-            else:
-                current_instance_type = instance_type
-
             logger.info("Deploying on %s" % zone)
 
             for index in range(n_nodes):
@@ -126,29 +249,60 @@ class gcp_provisioner(cloud_provisioning):
                         continue
 
                 logger.info('Deploying %s with %s instance type, using %s image' %
-                            (node_name, current_instance_type, current_image.name))
-
-                node = driver.create_node(name=node_name,
-                                          image=current_image,
-                                          size=current_instance_type,
-                                          ex_metadata=metadata,
-                                          location=zone)
-                self.nodes.append(node)
-                index += 1
+                            (node_name, current_instance_type.name, current_image.name))
+                future = executor.submit(self._create_node, limiter, node_name, current_image,
+                                         current_instance_type, metadata, zone)
+                futures[future] = node_name
+
+        for future in as_completed(futures):
+            node_name = futures[future]
+            try:
+                self.nodes.append(future.result())
+            except Exception as e:
+                logger.error('Cannot create %s: %s' % (node_name, e))
+                self.errors[node_name] = str(e)
+        executor.shutdown()
+        if self.errors:
+            logger.error('Failed to create %s/%s nodes: %s' % (len(self.errors), len(futures),
+                                                               ', '.join(sorted(self.errors))))
         logger.info("Finish provisioning nodes on GCP\n")
 
         return driver
 
-    def get_resources(self):
+    def get_resources(self, on_host_ready=None):
         """Retriving the public IPs of the list of provisioned hosts
+
+        Parameters
+        ----------
+        on_host_ready: function
+            called with the public IP of each host as soon as it is reachable by SSH,
+            so that the host can be configured while the other hosts are still booting,
+            the calls run concurrently in a pool of threads and are all waited for before returning
         """
         logger.info("Retriving the public IPs of all nodes on GCP")
-        for node in self.nodes:
-            if len(node.public_ips) > 0:
+        ready_nodes = list()
+        # the callbacks run in their own threads, so that the polling of the other nodes
+        # goes on and their time does not count against the readiness timeout
+        with ThreadPoolExecutor(max_workers=self.max_workers) as callback_executor:
+            callback_futures = dict()
+            for node in self.iter_ready_nodes():
+                ready_nodes.append(node)
                 self.hosts.append(node.public_ips[0])
+                if on_host_ready is not None:
+                    future = callback_executor.submit(on_host_ready, node.public_ips[0])
+                    callback_futures[future] = node.public_ips[0]
+            self.nodes = ready_nodes + self.nodes_not_ready
+            callback_errors = list()
+            for future in as_completed(callback_futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('Exception when handling the ready host %s: %s' % (callback_futures[future], e))
+                    callback_errors.append(e)
+        if callback_errors:
+            raise callback_errors[0]
         logger.info("Finish retriving the public IPs\n")
 
-    def provisioning(self):
-        driver = self.make_reservation()
-        self._wait_hosts_up(driver)
-        self.get_resources()
+    def provisioning(self, on_host_ready=None):
+        self.make_reservation()
+        self.get_resources(on_host_ready)
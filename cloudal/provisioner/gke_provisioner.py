@@ -1,20 +1,31 @@
 import os
-from time import sleep
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from google.cloud.container_v1.services.cluster_manager import ClusterManagerClient
-from google.cloud.container_v1.types import Cluster
+from google.cloud.container_v1.types import Cluster, Operation
 
 from cloudal.provisioner.provisioning import cloud_provisioning
 from cloudal.utils import get_logger
 
 logger = get_logger()
 
+# the maximum time (in seconds) to wait for all the clusters to be running
+PROVISIONING_TIMEOUT = 1800
+# the first interval (in seconds) between two polls of a cluster creation,
+# which grows exponentially up to POLL_MAX_INTERVAL
+POLL_INITIAL_INTERVAL = 10
+POLL_MAX_INTERVAL = 60
+POLL_BACKOFF = 1.5
+
 
 class gke_provisioner(cloud_provisioning):
     def __init__(self, **kwargs):
         self.config_file_path = kwargs.get('config_file_path')
         self.configs = kwargs.get('configs')
         self.clusters = list()
+        # key: zone:cluster_name, value: the error when creating the cluster
+        self.errors = dict()
 
         if self.configs and isinstance(self.configs, dict):
             logger.debug("Use configs instead of config file")
@@ -31,64 +42,157 @@ class gke_provisioner(cloud_provisioning):
             service_account_credentials_json_file_path)
         return cluster_manager_client
 
-    def _get_existed_clusters(self, project_id, list_zones, cluster_manager_client):
+    def _get_existed_clusters(self, project_id, cluster_manager_client):
         clusters_ok = dict()
         clusters_ko = dict()
 
-        for zone in list_zones:
-            list_clusters = cluster_manager_client.list_clusters(project_id=project_id, zone=zone)
-
-            for cluster in list_clusters.clusters:
-                key = '%s:%s' % (zone, cluster.name)
-                if cluster.status == 2:
-                    clusters_ok[key] = cluster
-                else:
-                    clusters_ko[key] = cluster
+        # the "-" zone lists the clusters of all zones in one request
+        list_clusters = cluster_manager_client.list_clusters(project_id=project_id, zone='-')
+        for cluster in list_clusters.clusters:
+            key = '%s:%s' % (cluster.location, cluster.name)
+            if cluster.status == Cluster.Status.RUNNING:
+                clusters_ok[key] = cluster
+            else:
+                clusters_ko[key] = cluster
 
         return clusters_ok, clusters_ko
 
-    def provisioning(self):
-        logger.info("Starting provisioning Kubernetes clusters")
+    def _create_cluster(self, cluster_manager_client, project_id, cluster):
+        logger.info('Deploying K8s cluster "%s" with %s nodes in zone %s' %
+                    (cluster['cluster_name'], cluster['n_nodes'], cluster['zone']))
+        cluster_specs = Cluster(mapping={
+            'name': cluster['cluster_name'],
+            'locations': [cluster['zone']],
+            'initial_node_count': cluster['n_nodes'],
+            'ip_allocation_policy': {'use_ip_aliases': True}
+        })
+        return cluster_manager_client.create_cluster(cluster=cluster_specs,
+                                                     parent='projects/%s/locations/%s' % (project_id, cluster['zone']))
+
+    def iter_running_clusters(self, timeout=PROVISIONING_TIMEOUT):
+        """Create the Kubernetes clusters concurrently and yield each cluster as soon as it is running
+
+        All the create_cluster requests are sent at the same time, then the returned operations
+        are polled with an exponential backoff. The clusters that fail are stored in self.errors.
+
+        Parameters
+        ----------
+        timeout: int
+            the maximum time to wait for all the clusters in seconds
+
+        Yields
+        ------
+        google.cloud.container_v1.types.Cluster
+            a running cluster
+        """
         cluster_manager_client = self._get_gke_client()
         project_id = self.configs['project_id']
-        list_zones = list()
-        for cluster in self.configs['clusters']:
-            list_zones.append(cluster['zone'])
 
         logger.info("Checking the Kubernetes clusters exist or not")
-        clusters_ok, clusters_ko = self._get_existed_clusters(project_id, list_zones, cluster_manager_client)
+        clusters_ok, clusters_ko = self._get_existed_clusters(project_id, cluster_manager_client)
 
+        # key: zone:cluster_name, value: dict of the zone, the cluster name and the creation operation
+        pending_clusters = dict()
+        clusters_to_create = list()
         for cluster in self.configs['clusters']:
             key = '%s:%s' % (cluster['zone'], cluster['cluster_name'])
             if key in clusters_ok:
                 logger.info('Cluster %s in zone %s already existed and is running' %
                             (cluster['cluster_name'], cluster['zone']))
-                self.clusters.append(clusters_ok[key])
+                yield clusters_ok[key]
             elif key in clusters_ko:
                 logger.info('Cluster "%s" in zone %s already existed but not running' %
                             (cluster['cluster_name'], cluster['zone']))
+                if clusters_ko[key].status in (Cluster.Status.PROVISIONING, Cluster.Status.RECONCILING):
+                    pending_clusters[key] = {'zone': cluster['zone'],
+                                             'name': cluster['cluster_name'],
+                                             'operation': None}
             else:
-                logger.info('Deploying K8s cluster "%s" with %s nodes in zone %s' %
-                            (cluster['cluster_name'], cluster['n_nodes'], cluster['zone']))
-                cluster_specs = Cluster(mapping={
-                    'name': cluster['cluster_name'],
-                    'locations': [cluster['zone']],
-                    'initial_node_count': cluster['n_nodes'],
-                    'ip_allocation_policy': {'use_ip_aliases': True}
-                })
-                cluster_manager_client.create_cluster(cluster=cluster_specs,
-                                                      parent='projects/%s/locations/%s' % (project_id, cluster['zone']))
-
-                sleep(40 * cluster['n_nodes'])
-                i = 0
-                while i < 10:
-                    c = cluster_manager_client.get_cluster(project_id=project_id,
-                                                           zone=cluster['zone'],
-                                                           cluster_id=cluster['cluster_name'])
-                    if c.status == 2:
-                        self.clusters.append(c)
-                        break
-                    i += 1
-                    # nodes take a while to boot up
-                    sleep(20)
+                clusters_to_create.append(cluster)
+
+        if clusters_to_create:
+            with ThreadPoolExecutor(max_workers=len(clusters_to_create)) as executor:
+                futures = {executor.submit(self._create_cluster, cluster_manager_client, project_id, cluster): cluster
+                           for cluster in clusters_to_create}
+                for future in as_completed(futures):
+                    cluster = futures[future]
+                    key = '%s:%s' % (cluster['zone'], cluster['cluster_name'])
+                    try:
+                        operation = future.result()
+                    except Exception as e:
+                        logger.error('Cannot create cluster %s: %s' % (key, e))
+                        self.errors[key] = str(e)
+                        continue
+                    pending_clusters[key] = {'zone': cluster['zone'],
+                                             'name': cluster['cluster_name'],
+                                             'operation': operation.name}
+
+        deadline = time.time() + timeout
+        intervals = {key: POLL_INITIAL_INTERVAL for key in pending_clusters}
+        next_polls = {key: time.time() + POLL_INITIAL_INTERVAL for key in pending_clusters}
+        while pending_clusters and time.time() < deadline:
+            key = min(next_polls, key=next_polls.get)
+            time.sleep(max(next_polls[key] - time.time(), 0))
+            pending = pending_clusters[key]
+            location = 'projects/%s/locations/%s' % (project_id, pending['zone'])
+            error = None
+            try:
+                if pending['operation'] is not None:
+                    operation = cluster_manager_client.get_operation(
+                        name='%s/operations/%s' % (location, pending['operation']))
+                    if operation.status == Operation.Status.DONE:
+                        error = operation.status_message or None
+                        pending['operation'] = None
+                if pending['operation'] is None and error is None:
+                    cluster = cluster_manager_client.get_cluster(
+                        name='%s/clusters/%s' % (location, pending['name']))
+                    if cluster.status == Cluster.Status.RUNNING:
+                        logger.info('Cluster %s is running' % key)
+                        del pending_clusters[key], next_polls[key]
+                        yield cluster
+                        continue
+                    if cluster.status == Cluster.Status.ERROR:
+                        error = cluster.status_message or 'the cluster is in ERROR status'
+            except Exception as e:
+                # a failed poll is retried at the next interval
+                logger.warning('Cannot get the status of cluster %s: %s' % (key, e))
+            if error is not None:
+                logger.error('Cannot create cluster %s: %s' % (key, error))
+                self.errors[key] = error
+                del pending_clusters[key], next_polls[key]
+                continue
+            intervals[key] = min(intervals[key] * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            next_polls[key] = time.time() + intervals[key]
+
+        for key in pending_clusters:
+            logger.error('Cluster %s is not running after %s seconds' % (key, timeout))
+            self.errors[key] = 'timeout'
+
+    def provisioning(self, on_cluster_ready=None):
+        """Provision the Kubernetes clusters on GKE
+
+        Parameters
+        ----------
+        on_cluster_ready: function
+            called with each cluster as soon as it is running,
+            the calls run concurrently in a pool of threads and are all waited for before returning
+        """
+        logger.info("Starting provisioning Kubernetes clusters")
+        # the callbacks run in their own threads, so that the polling of the other clusters
+        # goes on and their time does not count against the provisioning timeout
+        with ThreadPoolExecutor(max_workers=max(1, len(self.configs['clusters']))) as callback_executor:
+            callback_futures = dict()
+            for cluster in self.iter_running_clusters():
+                self.clusters.append(cluster)
+                if on_cluster_ready is not None:
+                    callback_futures[callback_executor.submit(on_cluster_ready, cluster)] = cluster.name
+            callback_errors = list()
+            for future in as_completed(callback_futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('Exception when handling the running cluster %s: %s' % (callback_futures[future], e))
+                    callback_errors.append(e)
+        if callback_errors:
+            raise callback_errors[0]
         logger.info("Finish provisioning Kubernetes clusters on GKE\n")
@@ -0,0 +1,169 @@
+import json
+import hashlib
+
+import yaml
+
+from cloudal.utils import get_logger, read_cache_file, write_cache_file
+
+from execo import Process, SshProcess
+from execo_g5k import get_host_site
+from execo_g5k.config import default_frontend_connection_params
+from execo_g5k.utils import get_frontend_host
+
+
+logger = get_logger()
+
+# the index of the captured images, key: the hash of the configuration steps
+IMAGES_INDEX_FILE = 'images_index.json'
+
+
+class image_baker(object):
+    """Capture a fully configured node into an image and reuse it on later runs
+
+    The images are identified by a hash of the configuration steps, so that a change
+    in the steps produces a new image. The captured images are recorded in a local index:
+        - g5k: a kadeploy environment description (used as custom_image)
+        - gcp: a GCE image of the project (used as cloud_provider_image)
+    """
+
+    def __init__(self, steps):
+        """
+        Parameters
+        ----------
+        steps: list
+            a JSON serializable description of the configuration steps performed on the nodes,
+            e.g. ['docker', 'kubeadm', {'packages': ['sysstat', 'htop']}]
+        """
+        self.steps = steps
+        self.key = hashlib.sha256(json.dumps(steps, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.image_name = 'cloudal-%s' % self.key
+
+    def _read_index(self):
+        return read_cache_file(IMAGES_INDEX_FILE) or dict()
+
+    def get_image(self, provider):
+        """Return the image captured for these configuration steps on a provider, None if not captured yet"""
+        return self._read_index().get(self.key, dict()).get(provider)
+
+    def register_image(self, provider, image):
+        """Record an image that contains these configuration steps on a provider
+
+        It can also be used to record an image that was built manually (e.g. an Azure image)
+        """
+        index = self._read_index()
+        index.setdefault(self.key, {'steps': self.steps})[provider] = image
+        write_cache_file(IMAGES_INDEX_FILE, index)
+        logger.info('Registered image %s for %s' % (image, provider))
+
+    def apply(self, configs, provider):
+        """Use the captured image in the provisioning configs if it exists
+
+        Parameters
+        ----------
+        configs: dict
+            the provisioning configs
+
+        provider: str
+            'g5k', 'gcp' or 'azure'
+
+        Returns
+        -------
+        bool
+            True if a captured image is used, so the configuration steps can be skipped
+        """
+        image = self.get_image(provider)
+        if image is None:
+            logger.info('No prebaked image found for the configuration steps %s' % self.key)
+            return False
+        logger.info('Using the prebaked image: %s' % image)
+        if provider == 'g5k':
+            # kadeploy accepts only one of env_file and env_name
+            configs['custom_image'] = image
+            configs['cloud_provider_image'] = None
+        else:
+            configs['cloud_provider_image'] = image
+            for cluster in configs.get('clusters', list()):
+                cluster['image'] = None
+        return True
+
+    def _run_on_frontend(self, cmd, site):
+        frontend = get_frontend_host(site)
+        if frontend:
+            process = SshProcess(cmd, frontend, connection_params=default_frontend_connection_params)
+        else:
+            process = Process(cmd, shell=True)
+        process.run()
+        if not process.ok:
+            raise Exception('Cannot run "%s" on the frontend of %s: %s' % (cmd, site, process.stderr.strip()))
+        return process.stdout
+
+    def capture_g5k(self, host, base_env):
+        """Capture a deployed node of Grid5000 into a kadeploy environment
+
+        The image archive and the environment description are stored in the public
+        directory of the site, so that they can be deployed on any site.
+
+        Parameters
+        ----------
+        host: str
+            the fully configured host to capture
+
+        base_env: str
+            the name of the environment that was deployed on the host (e.g. debian10-x64-big)
+
+        Returns
+        -------
+        str
+            the url of the environment description to use as custom_image
+        """
+        site = host.split('.')[1] if host.count('.') >= 2 else get_host_site(host)
+        logger.info('Capturing %s into the kadeploy environment %s' % (host, self.image_name))
+        user = self._run_on_frontend('whoami', site).strip()
+        public_url = 'http://public.%s.grid5000.fr/~%s/cloudal_images' % (site, user)
+
+        cmd = 'mkdir -p ~/public/cloudal_images && tgz-g5k -m %s -f ~/public/cloudal_images/%s.tgz' % (
+            host, self.image_name)
+        self._run_on_frontend(cmd, site)
+
+        env = yaml.safe_load(self._run_on_frontend('kaenv3 -p %s -u deploy' % base_env, site))
+        env['name'] = self.image_name
+        env['image']['file'] = '%s/%s.tgz' % (public_url, self.image_name)
+        env['description'] = 'cloudal prebaked image of the configuration steps %s' % self.key
+        cmd = "cat > ~/public/cloudal_images/%s.yaml <<'EOF'\n%sEOF" % (self.image_name,
+                                                                       yaml.safe_dump(env, default_flow_style=False))
+        self._run_on_frontend(cmd, site)
+
+        env_url = '%s/%s.yaml' % (public_url, self.image_name)
+        self.register_image('g5k', env_url)
+        return env_url
+
+    def capture_gcp(self, driver, node):
+        """Capture a configured GCE node into an image of the project
+
+        The node is stopped while its boot disk is captured, then started again.
+
+        Parameters
+        ----------
+        driver: libcloud.compute.drivers.gce.GCENodeDriver
+            the driver connected to the project of the node
+
+        node: libcloud.compute.base.Node
+            the fully configured node to capture
+
+        Returns
+        -------
+        str
+            the name of the image to use as cloud_provider_image
+        """
+        logger.info('Capturing %s into the image %s' % (node.name, self.image_name))
+        driver.ex_stop_node(node)
+        try:
+            image = driver.ex_create_image(name=self.image_name,
+                                           volume=node.extra['boot_disk'],
+                                           description='cloudal prebaked image of the configuration steps %s' % self.key,
+                                           family='cloudal',
+                                           use_existing=True)
+        finally:
+            driver.ex_start_node(node)
+        self.register_image('gcp', image.name)
+        return image.name
@@ -1,11 +1,26 @@
 import os
+import json
 import yaml
 import logging
+import shlex
+import shutil
+import socket
+import hashlib
+import asyncio
+import functools
+import time
+import threading
+import subprocess
 import tenacity
 from tenacity import retry
+from collections import deque
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
-from execo.action import ActionFactory
+from execo.action import ActionFactory, wait_any_actions
 from execo.config import TAKTUK, SSH, SCP, default_connection_params
+from execo.ssh_utils import get_ssh_command
+from execo.process import ProcessOutputHandler, STDOUT
 
 
 default_connection_params['taktuk_connector_options'] = ('-o', 'BatchMode=yes',
@@ -68,6 +83,68 @@ def parse_config_file(config_file_path):
                 return content
 
 
+# the directory to persist the data cached by cloudal between runs
+CACHE_DIR = os.path.expanduser('~/.cloudal')
+
+
+def read_cache_file(name, ttl=None):
+    """Read data from a JSON cache file in the cloudal cache directory
+
+    Parameters
+    ----------
+    name: str
+        the name of the cache file
+
+    ttl: int
+        the time to live of the cache in seconds, no expiration if None
+
+    Returns
+    -------
+    object
+        the cached data, None if the cache file does not exist, is not readable or is expired
+    """
+    file_path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(file_path):
+        return None
+    if ttl is not None and time.time() - os.path.getmtime(file_path) > ttl:
+        logger.debug('Cache file %s is expired' % file_path)
+        return None
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logger.warning('Cannot read cache file %s: %s' % (file_path, e))
+        return None
+
+
+def write_cache_file(name, data):
+    """Write data to a JSON cache file in the cloudal cache directory"""
+    file_path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    # write to a temporary file first so that a crash never leaves a truncated cache file
+    tmp_file_path = '%s.tmp' % file_path
+    with open(tmp_file_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.rename(tmp_file_path, file_path)
+
+
+# facts about the hosts collected by the configurators (e.g. the OS name)
+# key: str, the host; value: dict of facts. The facts of a host are cleared when it is redeployed
+host_facts_cache = dict()
+
+
+def clear_host_facts(hosts=None):
+    """Clear the cached facts of the given hosts, or of all hosts if None"""
+    if hosts is None:
+        host_facts_cache.clear()
+        return
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    for host in hosts:
+        host_facts_cache.pop(host, None)
+
+
 executor_singleton = list()
 
 
@@ -102,12 +179,320 @@ def get_remote_executor(remote_tool=SSH, fileput_tool=SCP, fileget_tool=SCP):
         return executor
 
 
+# from this number of hosts, the commands and file copies are propagated to the hosts
+# through a TakTuk tree instead of opening one SSH connection per host from local,
+# TakTuk is opt-in: set cloudal.utils.TAKTUK_THRESHOLD to a number of hosts (e.g. 100) to enable it,
+# it is read at call time so that g5k_provisioner also prepares the hosts for TakTuk
+TAKTUK_THRESHOLD = None
+
+taktuk_executor_singleton = list()
+
+
+def get_taktuk_executor():
+    '''Instantiate remote process execution and file copies tool which uses TakTuk for all operations
+
+    Returns
+    -------
+    ActionFactory
+        an object contains TakTuk remote process execution and file copies tools,
+        None if taktuk is not installed on the local machine
+    '''
+    global taktuk_executor_singleton
+    if len(taktuk_executor_singleton) == 0:
+        if shutil.which(default_connection_params['taktuk']) is None:
+            logger.warning('taktuk is not installed, using SSH for all hosts')
+            taktuk_executor_singleton.append(None)
+        else:
+            taktuk_executor_singleton.append(ActionFactory(remote_tool=TAKTUK,
+                                                           fileput_tool=TAKTUK,
+                                                           fileget_tool=TAKTUK))
+    return taktuk_executor_singleton[0]
+
+
+def disable_taktuk(reason):
+    """Use SSH for all hosts from now on, after TakTuk failed on the local machine"""
+    global taktuk_executor_singleton
+    logger.warning('TakTuk failed (%s), using SSH for all hosts' % reason)
+    taktuk_executor_singleton[:] = [None]
+
+
+def is_taktuk_fanout(hosts, taktuk_threshold=None):
+    """Check whether operations on the given hosts are propagated with TakTuk
+
+    The threshold defaults to the current value of TAKTUK_THRESHOLD
+    """
+    if taktuk_threshold is None:
+        taktuk_threshold = TAKTUK_THRESHOLD
+    if taktuk_threshold is None or len(hosts) < taktuk_threshold:
+        return False
+    return get_taktuk_executor() is not None
+
+
+def get_executor_for_hosts(hosts, batch_size, taktuk_threshold=None):
+    '''Choose the remote executor depending on the number of hosts
+
+    A TakTuk tree scales logarithmically with the number of hosts so it is used for large host sets,
+    while plain SSH/SCP is faster to set up for small host sets.
+
+    Returns
+    -------
+    ActionFactory
+        the remote executor to use
+
+    int
+        the batch size to chunk the hosts, TakTuk only opens one connection from local
+        so the hosts are not chunked
+    '''
+    if is_taktuk_fanout(hosts, taktuk_threshold):
+        return get_taktuk_executor(), max(len(hosts), 1)
+    return get_remote_executor(), batch_size
+
+
 def chunk_list(input_list, n):
     """Yield successive n-sized chunks from a list."""
     for i in range(0, len(input_list), n):
         yield input_list[i:i + n]
 
 
+# the number of chunks that are executed at the same time, so that at most
+# batch_size * MAX_CONCURRENT_CHUNKS connections are opened concurrently from local
+MAX_CONCURRENT_CHUNKS = 4
+
+
+def run_actions(actions, max_concurrent_chunks=MAX_CONCURRENT_CHUNKS):
+    """Run a list of actions with a bounded number of actions in flight
+
+    A sliding window is used: as soon as one action ends, the next pending
+    action is started, so that at most `max_concurrent_chunks` actions are running at once.
+
+    Parameters
+    ----------
+    actions: list of execo.action.Action
+        the actions to run, they must not be started yet
+
+    max_concurrent_chunks: int
+        the maximum number of actions running at the same time
+
+    Returns
+    -------
+    list of execo.action.Action
+        the ended actions, in the same order as the given actions
+    """
+    max_concurrent_chunks = max(1, max_concurrent_chunks or 1)
+    pending = list(actions)
+    running = list()
+    while pending or running:
+        while pending and len(running) < max_concurrent_chunks:
+            running.append(pending.pop(0).start())
+        finished = wait_any_actions(running)
+        running = [action for action in running if action not in finished]
+    return list(actions)
+
+
+TAKTUK_CONNECTION_ERRORS = ('taktuk connection failed', 'taktuk connection lost')
+
+
+def _start_actions(get_action, remote_executor, hosts, batch_size, mode, max_concurrent_chunks):
+    actions = [get_action(remote_executor, chunk) for chunk in chunk_list(hosts, batch_size)]
+    if mode == 'run':
+        run_actions(actions, max_concurrent_chunks)
+    elif mode == 'start':
+        for action in actions:
+            action.start()
+    return actions
+
+
+def run_remote_actions(get_action, hosts, batch_size, mode='run', max_concurrent_chunks=MAX_CONCURRENT_CHUNKS,
+                       taktuk_threshold=None):
+    """Create and run the actions on chunks of hosts with the executor chosen by get_executor_for_hosts
+
+    When TakTuk is used but fails on the local machine, TakTuk is disabled and the actions
+    are performed again with SSH. In run mode, the hosts that TakTuk cannot connect to
+    are also retried with SSH.
+
+    Parameters
+    ----------
+    get_action: function
+        a function(remote_executor, hosts) that returns the action to perform on these hosts
+
+    Returns
+    -------
+    list of execo.action.Action
+        the actions, the SSH actions of the retried hosts are placed after the TakTuk actions
+    """
+    remote_executor, chunk_size = get_executor_for_hosts(hosts, batch_size, taktuk_threshold)
+    if remote_executor is get_remote_executor():
+        return _start_actions(get_action, remote_executor, hosts, chunk_size, mode, max_concurrent_chunks)
+
+    try:
+        actions = _start_actions(get_action, remote_executor, hosts, chunk_size, mode, max_concurrent_chunks)
+    except Exception as e:
+        disable_taktuk(e)
+        return _start_actions(get_action, get_remote_executor(), hosts, batch_size, mode, max_concurrent_chunks)
+    if mode == 'run':
+        failed_hosts = [process.host.address for action in actions for process in action.processes
+                        if process.error_reason in TAKTUK_CONNECTION_ERRORS]
+        if failed_hosts:
+            logger.warning('TakTuk cannot connect to %s hosts, retrying them with SSH' % len(failed_hosts))
+            actions += _start_actions(get_action, get_remote_executor(), failed_hosts, batch_size, mode,
+                                      max_concurrent_chunks)
+    return actions
+
+
+# the connections of the pool are kept open in the background for this duration after the last use
+CONTROL_PERSIST = '30m'
+
+connection_pool_singleton = list()
+
+
+class ssh_connection_pool(object):
+    """A pool of persistent SSH connections (one multiplexed master connection per host)
+
+    When the pool is enabled, all the ssh/scp processes launched by the remote executor
+    reuse the master connection of their host (ControlMaster/ControlPersist of OpenSSH)
+    instead of performing a new SSH handshake.
+    """
+
+    def __init__(self, control_dir='~/.ssh/cloudal_cm', control_persist=CONTROL_PERSIST):
+        self.control_dir = os.path.expanduser(control_dir)
+        self.control_persist = control_persist
+        self.hosts = set()
+        self.is_enabled = False
+
+    def _control_options(self):
+        # %C is a hash of the connection (local host, remote host, port, user),
+        # it keeps the socket path short enough for a unix socket
+        return ('-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % os.path.join(self.control_dir, '%C'),
+                '-o', 'ControlPersist=%s' % self.control_persist,
+                '-o', 'ServerAliveInterval=15',
+                '-o', 'ServerAliveCountMax=3')
+
+    def enable(self):
+        """Add the connection multiplexing options to the ssh and scp default connection params"""
+        if self.is_enabled:
+            return
+        if not os.path.exists(self.control_dir):
+            os.makedirs(self.control_dir, mode=0o700)
+        for key in ['ssh_options', 'scp_options']:
+            default_connection_params[key] = tuple(default_connection_params[key]) + self._control_options()
+        self.is_enabled = True
+
+    def open(self, hosts, batch_size=5, max_concurrent_chunks=MAX_CONCURRENT_CHUNKS):
+        """Establish the master connections to the given hosts
+
+        Parameters
+        ----------
+        hosts: list of str
+            list of host names or IPs
+
+        Returns
+        -------
+        list of str
+            the hosts that cannot be connected to
+        """
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.enable()
+        logger.info('Opening persistent connections to %s hosts' % len(hosts))
+        remote_executor = get_remote_executor()
+        actions = [remote_executor.get_remote('true', chunk) for chunk in chunk_list(hosts, batch_size)]
+        run_actions(actions, max_concurrent_chunks)
+        host_errors = list()
+        for action in actions:
+            for process in action.processes:
+                if process.ok:
+                    self.hosts.add(process.host.address)
+                else:
+                    host_errors.append(process.host.address)
+        if host_errors:
+            logger.warning('Cannot open persistent connections to %s hosts:\n%s' %
+                           (len(host_errors), '\n'.join(host_errors)))
+        return host_errors
+
+    def _control_cmd(self, host, control_cmd):
+        cmd = list(get_ssh_command()) + ['-O', control_cmd, host]
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull)
+
+    def check(self, hosts=None):
+        """Check the master connections of the pool and evict the dead ones
+
+        Parameters
+        ----------
+        hosts: list of str
+            list of host names or IPs to check, all hosts of the pool are checked if None
+
+        Returns
+        -------
+        list of str
+            the evicted hosts
+        """
+        if hosts is None:
+            hosts = list(self.hosts)
+        dead_hosts = [host for host in hosts if self._control_cmd(host, 'check') != 0]
+        if dead_hosts:
+            logger.warning('Evicting %s dead hosts from the connection pool:\n%s' %
+                           (len(dead_hosts), '\n'.join(dead_hosts)))
+            self.evict(dead_hosts)
+        return dead_hosts
+
+    def evict(self, hosts):
+        """Close the master connections of the given hosts and remove them from the pool"""
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        for host in hosts:
+            self._control_cmd(host, 'exit')
+            self.hosts.discard(host)
+
+    def close(self):
+        """Close all the master connections of the pool"""
+        self.evict(list(self.hosts))
+
+
+def get_connection_pool():
+    '''Get the pool of persistent SSH connections used by the remote executor
+
+    The pool is only used after calling its open() function, e.g. once after provisioning:
+    get_connection_pool().open(hosts)
+
+    Returns
+    -------
+    ssh_connection_pool
+        the singleton connection pool
+    '''
+    global connection_pool_singleton
+    if len(connection_pool_singleton) == 0:
+        connection_pool_singleton.append(ssh_connection_pool())
+    return connection_pool_singleton[0]
+
+
+def is_ssh_ready(host, port=22, timeout=5):
+    """Check whether the SSH server of a host accepts connections
+
+    Parameters
+    ----------
+    host: str
+        the address of the host
+
+    port: int
+        the SSH port
+
+    timeout: int
+        the connection timeout in seconds
+
+    Returns
+    -------
+    bool
+        True if the host answers with an SSH banner
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            return sock.recv(4) == b'SSH-'
+    except (socket.error, socket.timeout):
+        return False
+
+
 class ExecuteCommandException(Exception):
     def __init__(self, message, is_continue=False):
         self.message = message
@@ -127,6 +512,65 @@ def custom_retry_return(state):
         raise(state.exception())
 
 
+class output_line_handler(ProcessOutputHandler):
+    """Handle the output of remote processes line by line
+
+    Each line is sent to a callback as soon as it is produced. If buffer_lines is set,
+    only the last buffer_lines lines of each stream are kept in process.stdout/process.stderr
+    instead of the entire output.
+    """
+
+    def __init__(self, callback=None, buffer_lines=None):
+        super(output_line_handler, self).__init__()
+        self.callback = callback
+        self.buffer_lines = buffer_lines
+        self.ring_buffers = dict()
+
+    def read(self, process, stream, string, eof, error):
+        super(output_line_handler, self).read(process, stream, string, eof, error)
+        if (eof or error) and self.buffer_lines:
+            ring_buffer = self.ring_buffers.pop((process, stream), list())
+            output = ''.join(ring_buffer)
+            if stream == STDOUT:
+                process.stdout = output
+            else:
+                process.stderr = output
+
+    def read_line(self, process, stream, line):
+        if self.buffer_lines:
+            key = (process, stream)
+            if key not in self.ring_buffers:
+                self.ring_buffers[key] = deque(maxlen=self.buffer_lines)
+            self.ring_buffers[key].append(line + '\n')
+        if self.callback:
+            try:
+                self.callback(process.host.address, 'stdout' if stream == STDOUT else 'stderr', line)
+            except Exception as e:
+                logger.error('Exception in output callback: %s' % e, exc_info=True)
+
+
+def get_output_process_args(output_callback=None, buffer_lines=None):
+    """Create the process arguments to stream the output of remote processes to a callback"""
+    if output_callback is None and buffer_lines is None:
+        return None
+    handler = output_line_handler(output_callback, buffer_lines)
+    process_args = {'stdout_handlers': [handler], 'stderr_handlers': [handler]}
+    if buffer_lines:
+        process_args['default_stdout_handler'] = False
+        process_args['default_stderr_handler'] = False
+    return process_args
+
+
+def _is_ssh_connection_error(process):
+    """Check whether ssh failed to connect to the host of a process (ssh exits with 255 in that case)"""
+    return process.exit_code == 255 or 'ssh_exchange_identification' in process.stderr
+
+
+def _is_failed_process(process):
+    """Check whether a process failed in a way that is worth to retry the command on its host"""
+    return 'ssh_exchange_identification' in process.stderr or (process.ok == False and process.stdout.strip())
+
+
 @retry(
     reraise=True,
     stop=tenacity.stop_after_attempt(10),
@@ -134,8 +578,42 @@ def custom_retry_return(state):
     retry_error_callback=custom_retry_return,
     retry=tenacity.retry_if_exception_type(ExecuteCommandException)
 )
-def execute_cmd(cmd, hosts, mode='run', batch_size=5, is_continue=False):
+def _execute_cmd_on_hosts(cmd, retry_hosts, processes, actions, mode, batch_size, is_continue,
+                          max_concurrent_chunks, taktuk_threshold, process_args):
+    """Perform a command on the hosts in retry_hosts, only the failed hosts are kept
+    in retry_hosts so that the next attempt is performed on these hosts only.
+
+    The latest process of each host is stored in the processes dict (key: host address)
+    and all the created actions are appended to the actions list.
+    """
+    # workaround to fix a bug of sending command to many hosts from personal machine outside of G5k:
+    # the hosts are chunked and only a few chunks are in flight at the same time
+    attempt = run_remote_actions(lambda remote_executor, chunk: remote_executor.get_remote(cmd, chunk,
+                                                                                          process_args=process_args),
+                                 retry_hosts, batch_size, mode, max_concurrent_chunks, taktuk_threshold)
+    actions += attempt
+
+    failed_hosts = list()
+    message = None
+    for action in attempt:
+        for process in action.processes:
+            processes[process.host.address] = process
+            if _is_failed_process(process):
+                failed_hosts.append(process.host.address)
+                message = process.stderr.strip()
+    retry_hosts[:] = failed_hosts
+    if failed_hosts:
+        logger.info('---> Retrying on %s hosts: %s\n' % (len(failed_hosts), cmd))
+        raise ExecuteCommandException(message=message, is_continue=is_continue)
+
+
+def execute_cmd(cmd, hosts, mode='run', batch_size=5, is_continue=False, max_concurrent_chunks=MAX_CONCURRENT_CHUNKS,
+                taktuk_threshold=None, output_callback=None, buffer_lines=None):
     """ Performing a command on remote hosts
+
+    When the command fails on some hosts, it is retried on these failed hosts only
+    and the processes of all attempts are merged into one result.
+
     Parameters
     ----------
     cmd: str
@@ -152,52 +630,122 @@ def execute_cmd(cmd, hosts, mode='run', batch_size=5, is_continue=False):
         chunk the hosts to smaller batches with batch size
 
     is_continue: bool
+        if True, do not raise exception when the command still fails on some hosts after retrying
+
+    max_concurrent_chunks: int
+        the number of batches that are executed at the same time
+
+    taktuk_threshold: int
+        from this number of hosts, the command is propagated with TakTuk instead of SSH,
+        TAKTUK_THRESHOLD is used if None (by default TakTuk is disabled)
+
+    output_callback: function
+        a function(host, stream, line) called for each line of output as soon as it is produced,
+        stream is either 'stdout' or 'stderr'
+
+    buffer_lines: int
+        only keep the last buffer_lines lines of stdout and stderr of each host in the result,
+        the entire output is kept if None
 
     Returns
     -------
+    host_errors: list of str
+        the hosts that cannot be connected to
+
+    result: execo.action.Action
+        the action which contains the latest process of every host
     """
     if hosts is None:
         raise Exception("Hosts cannot be None")
     if isinstance(hosts, str):
         hosts = [hosts]
-    remote_executor = get_remote_executor()
-    # workaround to fix a bug of sending command to many hosts from personal machine outside of G5k:
-    result = list()
-    for chunk in chunk_list(hosts, batch_size):
-        if mode == 'run':
-            result.append(remote_executor.get_remote(cmd, chunk).run())
-        elif mode == 'start':
-            result.append(remote_executor.get_remote(cmd, chunk).start())
+    processes = dict()
+    actions = list()
+    process_args = get_output_process_args(output_callback, buffer_lines)
+    _execute_cmd_on_hosts(cmd, list(hosts), processes, actions, mode, batch_size, is_continue,
+                          max_concurrent_chunks, taktuk_threshold, process_args)
 
     host_errors = list()
-    for chunk in result:
-        for process in chunk.processes:
-            if process.error_reason == 'taktuk connection failed':
-                host_errors.append(process.host)
-            if ('ssh_exchange_identification' in process.stderr or (process.ok == False and process.stdout.strip())):
-                logger.info('---> Retrying: %s\n' % cmd)
-                raise ExecuteCommandException(message=process.stderr.strip(), is_continue=is_continue)
-            # config host -> check for alive hosts at the end of the configuration
+    for host, process in processes.items():
+        if process.error_reason == 'taktuk connection failed':
+            host_errors.append(host)
+        # config host -> check for alive hosts at the end of the configuration
         # workflow -> detect by wrap the execute_cmd by another command and check
         #             for return host_errors --> remove host from all hosts/available host
         #             then cancel the combination, remember to check the finally statement of
         #             the workflow
-    if len(host_errors) == len(hosts):
+    if hosts and len(host_errors) == len(hosts):
         logger.error("Connection error to all hosts.\nProgram is terminated")
         exit()
     elif len(host_errors) > 0:
         logger.error("Connection error to %s hosts:\n%s" % (len(host_errors), '\n'.join(host_errors)))
         hosts = [host for host in hosts if host not in host_errors]
-    processes = list()
-    for each in result:
-        processes += each.processes
-    if result:
-        result[0].processes = processes
-        result[0].hosts = hosts
-        result = result[0]
+        get_connection_pool().evict([host for host in host_errors if host in get_connection_pool().hosts])
+    # the master connection of a host can be dead when ssh failed to connect to it
+    connection_pool = get_connection_pool()
+    ssh_failed_hosts = [host for host, process in processes.items()
+                        if host in connection_pool.hosts and _is_ssh_connection_error(process)]
+    if ssh_failed_hosts:
+        connection_pool.check(ssh_failed_hosts)
+    result = list()
+    if actions:
+        result = actions[0]
+        result.processes = list(processes.values())
+        result.hosts = hosts
     return host_errors, result
 
 
+# the number of the last output lines of each host that are kept when streaming a command
+STREAM_BUFFER_LINES = 100
+
+
+def stream_cmd(cmd, hosts, buffer_lines=STREAM_BUFFER_LINES, **kwargs):
+    """Perform a command on remote hosts and iterate over the output lines as they are produced
+
+    Parameters
+    ----------
+    cmd: str
+        command to perform on remote hosts
+
+    hosts: list of str
+        list of host names or IPs
+
+    buffer_lines: int
+        the number of the last output lines of each host that are kept in the processes
+
+    kwargs:
+        the other arguments of execute_cmd
+
+    Yields
+    ------
+    tuple
+        (host, stream, line) where stream is either 'stdout' or 'stderr'
+    """
+    lines = Queue()
+    end_of_stream = object()
+    errors = list()
+
+    def _execute():
+        try:
+            execute_cmd(cmd, hosts, output_callback=lambda *line: lines.put(line),
+                        buffer_lines=buffer_lines, **kwargs)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            lines.put(end_of_stream)
+
+    thread = threading.Thread(target=_execute)
+    thread.start()
+    while True:
+        line = lines.get()
+        if line is end_of_stream:
+            break
+        yield line
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
 def get_file(remote_file_paths, host, local_dir, mode='run'):
     """
     2 modes:
@@ -206,12 +754,13 @@ def get_file(remote_file_paths, host, local_dir, mode='run'):
     """
     remote_executor = get_remote_executor()
     if mode == 'run':
-        remote_executor.get_fileget(host, remote_file_paths, local_dir).run()
+        return remote_executor.get_fileget(host, remote_file_paths, local_dir).run()
     elif mode == 'start':
-        remote_executor.get_fileget(host, remote_file_paths, local_dir).start()
+        return remote_executor.get_fileget(host, remote_file_paths, local_dir).start()
 
 
-def getput_file(hosts, file_paths, dest_location, action, mode='run', batch_size=5):
+def getput_file(hosts, file_paths, dest_location, action, mode='run', batch_size=5,
+                max_concurrent_chunks=MAX_CONCURRENT_CHUNKS, taktuk_threshold=None, is_dedup=False):
     """Perform files copy between local and remote
 
     Parameters
@@ -239,19 +788,434 @@ def getput_file(hosts, file_paths, dest_location, action, mode='run', batch_size
         the list of hosts will be chunked into N chunks of size: batch_size before executing a command
         as a workaround to the limitation of Grid5k for the number of concurrent ssh connection from local
 
+    max_concurrent_chunks: int
+        the number of chunks that are copied at the same time
+
+    taktuk_threshold: int
+        from this number of hosts, the files are copied with TakTuk instead of SCP,
+        TAKTUK_THRESHOLD is used if None (by default TakTuk is disabled)
+
+    is_dedup: bool
+        only for the put action: skip the hosts that already have identical files
+        and copy the files from host to host (see distribute_files)
+
+    Returns
+    -------
+    list of execo.action.Action
+        the file copy actions, one per chunk of hosts
+    """
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    if is_dedup and action == 'put' and mode == 'run':
+        distribute_files(hosts, file_paths, dest_location, batch_size=batch_size,
+                         max_concurrent_chunks=max_concurrent_chunks)
+        return list()
+    if action == 'get':
+        def get_action(remote_executor, chunk):
+            return remote_executor.get_fileget(chunk, file_paths, dest_location)
+    elif action == 'put':
+        def get_action(remote_executor, chunk):
+            return remote_executor.get_fileput(chunk, file_paths, dest_location)
+    else:
+        return list()
+    return run_remote_actions(get_action, hosts, batch_size, mode, max_concurrent_chunks, taktuk_threshold)
+
+
+def get_file_checksum(file_path, block_size=1 << 20):
+    """Compute the sha256 checksum of a local file"""
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _get_hosts_missing_files(hosts, checksums, dest_location, batch_size, max_concurrent_chunks):
+    """Probe the checksums of the files on remote hosts and return the hosts that do not have identical copies"""
+    cmd = 'cd %s 2>/dev/null && sha256sum %s 2>/dev/null; true' % (
+        shlex.quote(dest_location), ' '.join(shlex.quote(file_name) for file_name in checksums))
+    _, r = execute_cmd(cmd, hosts, batch_size=batch_size, max_concurrent_chunks=max_concurrent_chunks)
+    missing_hosts = list()
+    for host, process in processes_by_host(r).items():
+        remote_checksums = dict()
+        for line in process.stdout.strip().splitlines():
+            if len(line.split()) == 2:
+                checksum, file_name = line.split()
+                remote_checksums[file_name] = checksum
+        if any(remote_checksums.get(file_name) != checksum for file_name, checksum in checksums.items()):
+            missing_hosts.append(host)
+    return missing_hosts
+
+
+# the options of the scp processes which copy the files from host to host,
+# the remote hosts use the ssh agent of local which is forwarded to them
+NODE_COPY_SCP_OPTIONS = '-o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=20'
+
+
+def _copy_files_between_hosts(pairs, file_names, dest_location, max_connections):
+    """Copy the files from the source host to the target host of each pair,
+    with at most max_connections SSH connections from local at the same time
+
+    Returns
+    -------
+    list of str
+        the target hosts where the copy succeeded
     """
     remote_executor = get_remote_executor()
+    connection_params = {'ssh_options': tuple(default_connection_params['ssh_options']) + ('-A',)}
+    actions = list()
+    for source, target in pairs:
+        cmd = 'cd %s && scp %s %s %s' % (shlex.quote(dest_location),
+                                         NODE_COPY_SCP_OPTIONS,
+                                         ' '.join(shlex.quote(file_name) for file_name in file_names),
+                                         shlex.quote('%s:%s' % (target, dest_location)))
+        actions.append(remote_executor.get_remote(cmd, [source], connection_params=connection_params))
+    run_actions(actions, max_connections)
+    return [target for (_, target), action in zip(pairs, actions) if action.ok]
+
+
+def distribute_files(hosts, file_paths, dest_location, batch_size=5, max_concurrent_chunks=MAX_CONCURRENT_CHUNKS):
+    """Send local files to remote hosts, skipping the hosts that already have identical copies
+
+    The files are identified by their sha256 checksums. They are sent once with SCP from local
+    to the first host which needs them, then copied over SSH from host to host: at each round,
+    every host which has the files copies them to one more host, so that the local uplink
+    bandwidth is used only once and the number of copies doubles at each round.
+    The hosts where the host to host copy failed get the files directly from local with SCP.
+    The directories are not deduplicated, they are sent to all hosts from local with SCP.
+    At most batch_size * max_concurrent_chunks SSH connections are opened from local at the same time.
+
+    Parameters
+    ----------
+    hosts: list of str
+        list of remote hosts to send files
+
+    file_paths: list of str
+        list of the local file paths to send
+
+    dest_location: str
+        the path to the destination directory on the remote hosts
+
+    Returns
+    -------
+    list of str
+        the hosts to which the files were copied
+    """
     if isinstance(hosts, str):
         hosts = [hosts]
-    result = list()
-    for chunk in chunk_list(hosts, batch_size):
-        act = None
-        if action == 'get':
-            act = remote_executor.get_fileget(chunk, file_paths, dest_location)
-        elif action == 'put':
-            act = remote_executor.get_fileput(chunk, file_paths, dest_location)
-        if act:
-            if mode == 'run':
-                result.append(act.run())
-            elif mode == 'start':
-                result.append(act.start())
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    # the directories have no checksum, they are always sent from local
+    dir_paths = [file_path for file_path in file_paths if os.path.isdir(file_path)]
+    if dir_paths:
+        logger.info('Copying %s directories from local to %s hosts' % (len(dir_paths), len(hosts)))
+        getput_file(hosts, dir_paths, dest_location, action='put',
+                    batch_size=batch_size, max_concurrent_chunks=max_concurrent_chunks)
+        file_paths = [file_path for file_path in file_paths if file_path not in dir_paths]
+        if not file_paths:
+            return list(hosts)
+    checksums = {os.path.basename(file_path.rstrip('/')): get_file_checksum(file_path) for file_path in file_paths}
+
+    missing_hosts = _get_hosts_missing_files(hosts, checksums, dest_location, batch_size, max_concurrent_chunks)
+    logger.info('%s/%s hosts already have the files, copying to %s hosts' %
+                (len(hosts) - len(missing_hosts), len(hosts), len(missing_hosts)))
+    if not missing_hosts:
+        return list(hosts) if dir_paths else list()
+
+    seed = missing_hosts[0]
+    getput_file([seed], file_paths, dest_location, action='put')
+    try:
+        sources = [seed]
+        pending_hosts = missing_hosts[1:]
+        while pending_hosts:
+            pairs = list(zip(sources, pending_hosts))
+            pending_hosts = pending_hosts[len(pairs):]
+            copied_hosts = _copy_files_between_hosts(pairs, list(checksums), dest_location,
+                                                     batch_size * max_concurrent_chunks)
+            if not copied_hosts:
+                break
+            sources += copied_hosts
+    except Exception as e:
+        logger.warning('Exception when copying the files from host to host: %s' % e)
+
+    failed_hosts = _get_hosts_missing_files(missing_hosts, checksums, dest_location, batch_size, max_concurrent_chunks)
+    if failed_hosts:
+        logger.info('Host to host copy failed on %s hosts, copying the files from local' % len(failed_hosts))
+        getput_file(failed_hosts, file_paths, dest_location, action='put',
+                    batch_size=batch_size, max_concurrent_chunks=max_concurrent_chunks)
+    return list(hosts) if dir_paths else missing_hosts
+
+
+# the commands to compress on remote hosts and to decompress on local
+COMPRESSORS = {
+    'zstd': ('zstd -q -c -T0', 'zstd -q -d -c'),
+    'gzip': ('gzip -c', 'gzip -d -c'),
+}
+
+
+class rate_limiter(object):
+    """A token bucket shared by many threads to cap the rate of operations (per second)"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, n=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + float(n) / self.rate
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class bandwidth_limiter(rate_limiter):
+    """A token bucket shared by many threads to cap the total bandwidth (bytes per second)"""
+
+
+def _get_compressed_files_from_host(host, remote_paths, local_dir, compressor, limiter, block_size=1 << 16):
+    """Stream the remote files as a compressed tar archive and extract it into local_dir while downloading"""
+    compress_cmd, decompress_cmd = COMPRESSORS[compressor]
+    tar_args = list()
+    for remote_path in remote_paths:
+        remote_path = remote_path.rstrip('/')
+        tar_args.append('-C %s %s' % (shlex.quote(os.path.dirname(remote_path) or '/'),
+                                      shlex.quote(os.path.basename(remote_path))))
+    remote_cmd = 'set -o pipefail; tar -cf - %s | %s' % (' '.join(tar_args), compress_cmd)
+    # no pseudo-terminal, it would alter the binary stream
+    ssh_cmd = [arg for arg in get_ssh_command() if arg != '-tt'] + [host, 'bash -c %s' % shlex.quote(remote_cmd)]
+    extract_cmd = '%s | tar -xf - -C %s' % (decompress_cmd, shlex.quote(local_dir))
+
+    remote = local = None
+    is_ok = False
+    with open(os.devnull, 'w') as devnull:
+        try:
+            remote = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE, stderr=devnull)
+            local = subprocess.Popen(extract_cmd, shell=True, stdin=subprocess.PIPE, stderr=devnull)
+            for block in iter(lambda: remote.stdout.read(block_size), b''):
+                limiter.consume(len(block))
+                local.stdin.write(block)
+            local.stdin.close()
+            is_ok = remote.wait() == 0 and local.wait() == 0
+        except Exception as e:
+            logger.error('Exception when downloading from %s: %s' % (host, e))
+        finally:
+            # a broken pipe can be raised again when closing, the failure of this host is reported by is_ok
+            for process in (remote, local):
+                if process is None:
+                    continue
+                if not is_ok and process.poll() is None:
+                    process.kill()
+                for stream in (process.stdin, process.stdout):
+                    if stream is not None:
+                        try:
+                            stream.close()
+                        except Exception:
+                            pass
+                process.wait()
+    return is_ok
+
+
+def get_compressed_files(hosts, remote_paths, local_dir, compressor='zstd', max_workers=10, bandwidth=None):
+    """Get files from many remote hosts concurrently as compressed streams
+
+    The files are compressed on the remote side (tar + zstd by default), downloaded concurrently
+    from max_workers hosts with a total bandwidth cap, and extracted into local_dir while downloading.
+    This is much faster than SCP for many small files.
+    The hosts where the compressed transfer failed (e.g. zstd is not installed) are retried with SCP.
+
+    Parameters
+    ----------
+    hosts: list of str
+        list of remote hosts to get the files from
+
+    remote_paths: list of str
+        list of the remote file or directory paths
+
+    local_dir: str
+        the path to the local directory to extract the files into
+
+    compressor: str
+        'zstd' or 'gzip'
+
+    max_workers: int
+        the number of hosts to download from at the same time
+
+    bandwidth: int
+        the total bandwidth cap in bytes per second, no cap if None
+
+    Returns
+    -------
+    list of str
+        the hosts where the compressed transfer failed
+    """
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    if isinstance(remote_paths, str):
+        remote_paths = [remote_paths]
+    if shutil.which(compressor) is None:
+        logger.warning('%s is not installed on local, using gzip' % compressor)
+        compressor = 'gzip'
+    limiter = bandwidth_limiter(bandwidth)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda host: _get_compressed_files_from_host(host, remote_paths, local_dir,
+                                                                            compressor, limiter), hosts))
+    failed_hosts = [host for host, is_ok in zip(hosts, results) if not is_ok]
+    if failed_hosts:
+        logger.warning('Compressed transfer failed on %s hosts, getting the files with SCP:\n%s' %
+                       (len(failed_hosts), '\n'.join(failed_hosts)))
+        getput_file(failed_hosts, remote_paths, local_dir, action='get')
+    return failed_hosts
+
+
+def _sync_files_from_host(host, remote_paths, local_dir, bwlimit):
+    """Synchronize remote files into local_dir with rsync, only new or changed files are transferred"""
+    ssh_cmd = ' '.join(shlex.quote(arg) for arg in get_ssh_command() if arg != '-tt')
+    # --partial keeps interrupted files so that the next sync resumes them with the delta algorithm
+    rsync_cmd = ['rsync', '-a', '--partial', '-e', ssh_cmd]
+    if bwlimit:
+        rsync_cmd.append('--bwlimit=%s' % bwlimit)
+    rsync_cmd += ['%s:%s' % (host, remote_path.rstrip('/')) for remote_path in remote_paths]
+    rsync_cmd.append(local_dir)
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(rsync_cmd, stdout=devnull, stderr=devnull) == 0
+
+
+def sync_files(hosts, remote_paths, local_dir, max_workers=10, bandwidth=None):
+    """Incrementally get files from many remote hosts
+
+    Only new or changed files (different size or modification time) are transferred,
+    changed files are transferred as deltas and interrupted transfers are resumed.
+    The hosts where rsync failed (e.g. rsync is not installed) get all the files with get_compressed_files.
+
+    Parameters
+    ----------
+    hosts: list of str
+        list of remote hosts to get the files from
+
+    remote_paths: list of str
+        list of the remote file or directory paths
+
+    local_dir: str
+        the path to the local directory to synchronize the files into
+
+    max_workers: int
+        the number of hosts to synchronize at the same time
+
+    bandwidth: int
+        the total bandwidth cap in bytes per second, no cap if None
+
+    Returns
+    -------
+    list of str
+        the hosts where the incremental transfer failed
+    """
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    if isinstance(remote_paths, str):
+        remote_paths = [remote_paths]
+    if shutil.which('rsync') is None:
+        logger.warning('rsync is not installed on local, getting all the files')
+        get_compressed_files(hosts, remote_paths, local_dir, max_workers=max_workers, bandwidth=bandwidth)
+        return list(hosts)
+    bwlimit = None
+    if bandwidth:
+        # rsync --bwlimit is in KiB per second and per process
+        bwlimit = max(1, bandwidth // 1024 // max(1, min(max_workers, len(hosts))))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda host: _sync_files_from_host(host, remote_paths, local_dir, bwlimit), hosts))
+    failed_hosts = [host for host, is_ok in zip(hosts, results) if not is_ok]
+    if failed_hosts:
+        logger.warning('Incremental transfer failed on %s hosts, getting all the files:\n%s' %
+                       (len(failed_hosts), '\n'.join(failed_hosts)))
+        get_compressed_files(failed_hosts, remote_paths, local_dir, max_workers=max_workers, bandwidth=bandwidth)
+    return failed_hosts
+
+
+def processes_by_host(result):
+    """Map each host address to its process in the result of execute_cmd (or list of actions)"""
+    if not isinstance(result, list):
+        result = [result]
+    return {process.host.address: process for action in result for process in action.processes}
+
+
+async def _run_in_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def async_execute_cmd(cmd, hosts, **kwargs):
+    """The awaitable version of execute_cmd
+
+    The command is performed in a worker thread so that other steps can run
+    in the event loop at the same time. All the keyword arguments of execute_cmd
+    are accepted and the ExecuteCommandException is raised the same way.
+
+    Returns
+    -------
+    host_errors: list of str
+        the hosts that cannot be connected to
+
+    result: dict
+        key: str, the host address
+        value: execo.process.SshProcess, the process of the command on that host
+    """
+    host_errors, result = await _run_in_thread(execute_cmd, cmd, hosts, **kwargs)
+    return host_errors, processes_by_host(result) if result else dict()
+
+
+async def async_getput_file(hosts, file_paths, dest_location, action, **kwargs):
+    """The awaitable version of getput_file
+
+    Returns
+    -------
+    dict
+        key: str, the host address
+        value: execo.process.Process, the file copy process of that host
+    """
+    acts = await _run_in_thread(getput_file, hosts, file_paths, dest_location, action, **kwargs)
+    return processes_by_host(acts)
+
+
+async def async_get_file(remote_file_paths, host, local_dir, mode='run'):
+    """The awaitable version of get_file
+
+    Returns
+    -------
+    dict
+        key: str, the host address
+        value: execo.process.Process, the file copy process of that host
+    """
+    act = await _run_in_thread(get_file, remote_file_paths, host, local_dir, mode)
+    return processes_by_host(act)
+
+
+async def gather_with_concurrency(limit, *aws):
+    """Run awaitables concurrently with at most `limit` of them running at the same time
+
+    Each awaitable of async_execute_cmd opens up to batch_size * max_concurrent_chunks connections,
+    so the limit also bounds the number of concurrent connections from local.
+
+    Parameters
+    ----------
+    limit: int
+        the maximum number of awaitables running at the same time
+
+    aws: awaitables
+        e.g. async_execute_cmd(cmd, hosts)
+
+    Returns
+    -------
+    list
+        the results of the awaitables, in the same order
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _run_with_semaphore(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[_run_with_semaphore(aw) for aw in aws])
@@ -3,7 +3,7 @@ import traceback
 
 from time import sleep
 
-from cloudal.utils import get_logger, execute_cmd, parse_config_file, getput_file
+from cloudal.utils import get_logger, execute_cmd, parse_config_file, getput_file, stream_cmd
 from cloudal.action import performing_actions_g5k
 from cloudal.provisioner import g5k_provisioner
 from cloudal.configurator import kubernetes_configurator, k8s_resources_configurator, packages_configurator
@@ -150,7 +150,8 @@ class elmerfs_g5k(performing_actions_g5k):
         logger.info("Building elmerfs")
         cmd = " cd /tmp/elmerfs_repo/ \
                 && docker build -t elmerfs ."
-        execute_cmd(cmd, kube_master)
+        for host, _, line in stream_cmd(cmd, kube_master):
+            logger.debug('[%s] %s' % (host, line))
 
         cmd = "docker run --name elmerfs elmerfs \
                 && docker cp -L elmerfs:/elmerfs/target/release/main /tmp/elmerfs \
@@ -164,7 +165,7 @@ class elmerfs_g5k(performing_actions_g5k):
         logger.info("Uploading elmerfs binary file from local to %s elmerfs hosts" %
                     len(elmerfs_hosts))
         getput_file(hosts=elmerfs_hosts, file_paths=[
-                    elmerfs_file_path], dest_location='/tmp', action='put')
+                    elmerfs_file_path], dest_location='/tmp', action='put', is_dedup=True)
         cmd = "chmod +x /tmp/elmerfs \
                && mkdir -p /tmp/dc-$(hostname)"
         execute_cmd(cmd, elmerfs_hosts)
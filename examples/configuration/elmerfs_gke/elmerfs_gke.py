@@ -7,7 +7,7 @@ from time import sleep
 
 from cloudal.utils import get_logger, execute_cmd, getput_file, parse_config_file
 from cloudal.action import performing_actions
-from cloudal.provisioner import gke_provisioner, gcp_provisioner
+from cloudal.provisioner import provisioning_engine
 from cloudal.configurator import k8s_resources_configurator, docker_configurator, packages_configurator
 
 from kubernetes import client
@@ -246,17 +246,14 @@ class elmerfs_gke(performing_actions):
 
     def setup_env(self):
         configs_gke, configs_gcp = self.create_configs()
-        logger.info('Starting provisioning K8s clusters on GKE to deploy an antidoteDB cluster')
-        logger.debug("Init provisioner: gke_provisioner")
-        provisioner = gke_provisioner(configs=configs_gke)
-        provisioner.provisioning()
-        clusters_gke = provisioner.clusters
-
-        logger.info('Starting provisioning nodes on GCP to deploy elmerfs nodes')
-        logger.debug("Init provisioner: gke_provisioner")
-        provisioner = gcp_provisioner(configs=configs_gcp)
-        provisioner.provisioning()
-        hosts_gcp = provisioner.hosts
+        logger.info('Starting provisioning K8s clusters on GKE to deploy an antidoteDB cluster '
+                    'and nodes on GCP to deploy elmerfs nodes')
+        logger.debug("Init provisioning engine")
+        engine = provisioning_engine([{'name': 'antidote', 'provider': 'gke', 'configs': configs_gke},
+                                      {'name': 'elmerfs', 'provider': 'gcp', 'configs': configs_gcp}])
+        provisioners = engine.run()
+        clusters_gke = provisioners['antidote'].clusters
+        hosts_gcp = provisioners['elmerfs'].hosts
 
         kube_namespace = 'antidote'
         antidote_services_ips = self.config_antidote(kube_namespace, clusters_gke, configs_gke)
@@ -82,7 +82,8 @@ class FMKe_antidotedb_g5k(performing_actions_g5k):
             with open(file_path2, 'w') as f:
                 f.write(doc)
             logger.debug('Upload fmke_client config files to kube_master to be used by kubectl to run fmke_client pods')
-            getput_file(hosts=exp_nodes, file_paths=[file_path2], dest_location='/tmp/fmke_client/', action='put')
+            getput_file(hosts=exp_nodes, file_paths=[file_path2], dest_location='/tmp/fmke_client/', action='put',
+                        is_dedup=True)
 
         logger.debug('Create create_fmke_client.yaml files to run job stress for each Antidote DC')
         file_path = os.path.join(fmke_client_k8s_dir, 'create_fmke_client.yaml.template')